@@ -13,8 +13,9 @@ setup(
     name="skill-newyear-quest",
     version=VERSION,
     package_dir={"skill_newyear_quest": "src/skill_newyear_quest"},
-    python_requires=">=3.6",
+    python_requires=">=3.8",
     packages=find_packages(where="src", include=["skill_newyear_quest"]),
+    package_data={"skill_newyear_quest": ["data/*.json"]},
     url="https://gitlab.com/nickandreevart/skill_newyear_quest",
     license="MIT",
     author="n.andreev",
@@ -0,0 +1,149 @@
+"""Micro-benchmarks of the quest engine functions on the request path.
+
+Every function is measured on its own, offline, with the bundled quest and
+in-memory sessions; remove_old_sessions is measured for every --sizes
+store size with half of the sessions expired.
+
+Run: PYTHONPATH=src python3 -m benchmarks.bench_engine [--sizes 10000,100000]
+"""
+
+import asyncio
+import copy
+import json
+import random
+import time
+from typing import Dict, List, Optional
+
+from skill_newyear_quest import quest, session_store, sessions, utils
+
+from .bench_load import TEMPLATE_PATH
+from .corpus import load_utterances
+from .timing import make_parser, measure, report
+
+SESSION_LIFE_TIME = 3600
+LOOKUPS = 10000
+
+
+def make_store(size: int, expired: float = 0.0) -> session_store.MemorySessionStore:
+    store = session_store.MemorySessionStore()
+    now = time.time()
+    records = {}
+    for index in range(size):
+        session_id = f"{index:064x}"
+        # Spread over the expiry buckets, far enough from the remove time
+        if index < size * expired:
+            last_time = now - 2 * SESSION_LIFE_TIME - index % SESSION_LIFE_TIME
+        else:
+            last_time = now - index % (SESSION_LIFE_TIME // 2)
+        records[session_id] = sessions.UserSession(
+            session_id, sessions.State.QUEST, index % 50, last_time
+        )
+    asyncio.get_event_loop().run_until_complete(store.set_many(records))
+    return store
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = make_parser(__doc__.splitlines()[0])
+    parser.add_argument("--corpus", help="JSONL file with requests to replay")
+    parser.add_argument(
+        "--sizes",
+        default="10000,100000,1000000",
+        help="comma separated session store sizes for remove_old_sessions",
+    )
+    args = parser.parse_args(argv)
+
+    if not quest.STAGES_DICTIONARY:
+        quest.init("https://localhost/{file_name}.mp3")
+    corpus = load_utterances(args.corpus)
+    prepared = [utils.prepare_phrase(text) for text in corpus]
+
+    template = json.loads(TEMPLATE_PATH.read_text(encoding="utf-8"))
+    requests: List[Dict] = []
+    for text in corpus:
+        request = copy.deepcopy(template)
+        request["request"]["command"] = text
+        requests.append(request)
+
+    rng = random.Random(2023)
+    choice_stages = [
+        stage for stage in quest.STAGES_DICTIONARY.values() if stage.transitions
+    ]
+    pairs = [(rng.choice(choice_stages), text) for text in prepared]
+    transitions = [
+        (rng.choice(stage.transitions), text) for stage, text in pairs  # type: ignore
+    ]
+    all_stages = list(quest.STAGES_DICTIONARY.values())
+
+    def run_prepare_phrase():
+        for text in corpus:
+            utils.prepare_phrase(text)
+
+    def run_get_prepared_text():
+        for request in requests:
+            utils.get_prepared_text(request)
+
+    def run_must_go():
+        for transition, text in transitions:
+            transition.must_go(text)
+
+    def run_get_next_stage():
+        for stage, text in pairs:
+            stage.get_next_stage(text)
+
+    def run_add_response_text_and_tts():
+        for stage in all_stages:
+            stage.add_response_text_and_tts(["", ""])
+
+    loop = asyncio.get_event_loop()
+    lookup_store = make_store(LOOKUPS)
+    lookup_ids = list(lookup_store.records)
+
+    async def get_sessions():
+        for session_id in lookup_ids:
+            await sessions.get_session(session_id)
+
+    def run_get_session():
+        sessions.init(SESSION_LIFE_TIME, lookup_store)
+        loop.run_until_complete(get_sessions())
+
+    results = [
+        measure("prepare_phrase", run_prepare_phrase, len(corpus), args.repeat),
+        measure("get_prepared_text", run_get_prepared_text, len(requests), args.repeat),
+        measure("Transition.must_go", run_must_go, len(transitions), args.repeat),
+        measure("Stage.get_next_stage", run_get_next_stage, len(pairs), args.repeat),
+        measure(
+            "Stage.add_response_text_and_tts",
+            run_add_response_text_and_tts,
+            len(all_stages),
+            args.repeat,
+        ),
+        measure("get_session[hit]", run_get_session, LOOKUPS, args.repeat),
+    ]
+
+    for size in [int(size) for size in args.sizes.split(",")]:
+
+        def setup():
+            store = make_store(size, expired=0.5)
+            sessions.init(SESSION_LIFE_TIME, store)
+            return store
+
+        def run_remove_old_sessions(store):
+            loop.run_until_complete(sessions.remove_old_sessions())
+            assert len(store.records) == size - size // 2
+
+        result = measure(
+            f"remove_old_sessions[{size}]",
+            run_remove_old_sessions,
+            size,
+            # Building a store of a million sessions takes seconds
+            min(args.repeat, 3),
+            setup,
+        )
+        result["removed"] = size // 2
+        results.append(result)
+
+    report(results, args.json)
+
+
+if __name__ == "__main__":
+    main()
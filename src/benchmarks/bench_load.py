@@ -0,0 +1,248 @@
+"""End-to-end load test of the skill served by an in-process aiohttp server.
+
+Virtual users play multi-turn dialogs concurrently over HTTP: every user
+starts a new session and walks the quest graph by answering with random
+transition phrases, sometimes asking to repeat or saying something the
+quest does not expect. Dialogs are generated with a fixed seed, so runs of
+different commits send the same traffic. With --replay, Marusya requests
+recorded one per line in a JSONL file are replayed instead, each user id
+being one dialog in the recorded order. Every dialog a virtual user plays
+gets a user and session id of its own, so no dialog meets an old session.
+
+The client runs on the same event loop as the server, so the numbers
+include its overhead; compare them between commits, not with production.
+
+Run: PYTHONPATH=src python3 -m benchmarks.bench_load [--users 1,10,50]
+"""
+
+import asyncio
+import copy
+import json
+import random
+import resource
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+from skill_newyear_quest import application, graphite_statistics, phrases
+
+from .timing import make_parser, report
+
+TEMPLATE_PATH = Path(__file__).parent.parent / "tests" / "base_request.json"
+
+# Share of turns answered with a repeat request or an unexpected phrase
+REPEAT_RATE = 0.05
+UNKNOWN_RATE = 0.1
+UNKNOWN_PHRASES = ["не знаю", "что", "а можно подумать", "эээ"]
+
+
+def make_request(template: Dict, user_id: str, command: str, new: bool) -> Dict:
+    request = copy.deepcopy(template)
+    request["request"]["command"] = command
+    request["request"]["original_utterance"] = command
+    request["request"]["nlu"]["tokens"] = command.split()
+    request["session"]["user_id"] = user_id
+    request["session"]["session_id"] = f"session-{user_id}"
+    request["session"]["new"] = new
+    return request
+
+
+def generate_dialog(
+    quest_registry, template: Dict, user_id: str, rng: random.Random, turns: int
+) -> List[Dict]:
+    current_quest = quest_registry.default
+    dialog = [
+        make_request(template, user_id, "включи новогодний квест", True),
+        make_request(template, user_id, "да", False),
+    ]
+    stage = current_quest.get_root_stage()
+    while len(dialog) < turns:
+        while stage.is_unconditional():
+            stage = stage.get_next_stage()
+        if stage.is_end():
+            break
+
+        chance = rng.random()
+        if chance < REPEAT_RATE:
+            command = rng.choice(phrases.SIMPLE_REPEAT_PHRASES)
+        elif chance < REPEAT_RATE + UNKNOWN_RATE:
+            command = rng.choice(UNKNOWN_PHRASES)
+            stage = stage.get_next_stage(command)
+        else:
+            transition = rng.choice(stage.transitions)
+            command = rng.choice([transition.main_text[0]] + transition.synonims)
+            stage = stage.get_next_stage(command)
+        dialog.append(make_request(template, user_id, command, False))
+
+    for message_id, request in enumerate(dialog):
+        request["session"]["message_id"] = message_id
+    return dialog
+
+
+def load_dialogs(path: str) -> List[List[Dict]]:
+    dialogs: Dict[str, List[Dict]] = {}
+    with Path(path).open(encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                request = json.loads(line)
+                user_id = request["session"]["user_id"]
+                dialogs.setdefault(user_id, []).append(request)
+    return list(dialogs.values())
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 2**20
+    except OSError:
+        # Peak instead of current RSS, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def play_user(
+    client: aiohttp.ClientSession,
+    url: str,
+    dialogs: List[List[Dict]],
+    deadline: float,
+    latencies: List[float],
+    errors: List[int],
+    offset: int,
+    level: int,
+) -> None:
+    index = offset
+    while time.perf_counter() < deadline:
+        # Every pass is a new user, the server has no session of it yet
+        user_id = f"level{level}-vu{offset}-{index - offset}"
+        for request in dialogs[index % len(dialogs)]:
+            session = {
+                **request["session"],
+                "user_id": user_id,
+                "session_id": f"session-{user_id}",
+            }
+            body = json.dumps(
+                {**request, "session": session}, ensure_ascii=False
+            ).encode("utf-8")
+            started = time.perf_counter()
+            async with client.post(
+                url, data=body, headers={"Content-Type": "application/json"}
+            ) as response:
+                await response.read()
+                if response.status != 200:
+                    errors[0] += 1
+            latencies.append(time.perf_counter() - started)
+            if time.perf_counter() >= deadline:
+                return
+        index += 1
+
+
+def percentile(values: List[float], percent: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def run_level(
+    url: str,
+    dialogs: List[List[Dict]],
+    users: int,
+    duration: float,
+    level: int,
+    metrics: graphite_statistics.GraphiteSender,
+):
+    repeated = metrics.counters.get("requests_repeated", 0)
+    latencies: List[float] = []
+    errors = [0]
+    connector = aiohttp.TCPConnector(limit=users)
+    async with aiohttp.ClientSession(connector=connector) as client:
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(
+            *[
+                play_user(
+                    client, url, dialogs, deadline, latencies, errors, user, level
+                )
+                for user in range(users)
+            ]
+        )
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "name": f"load users={users}",
+        "operations": len(latencies),
+        "seconds": elapsed,
+        "ops_per_sec": len(latencies) / elapsed,
+        "ns_per_op": elapsed * 1e9 / max(len(latencies), 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "errors": errors[0],
+        # Answered from the response cache, should stay 0 for comparable runs
+        "repeated": metrics.counters.get("requests_repeated", 0) - repeated,
+        "rss_mb": round(rss_mb(), 1),
+    }
+
+
+async def run(
+    levels: List[int],
+    duration: float,
+    dialog_count: int,
+    turns: int,
+    seed: int,
+    replay: Optional[str],
+) -> List[Dict]:
+    config = application.load_config()
+    config.set("sessions", "backend", "memory")
+    config.set("sessions", "snapshot_dir", "")
+    # Never started, nothing is sent to Graphite
+    metrics = graphite_statistics.GraphiteSender("127.0.0.1", "load")
+    app = application.create_app(config, metrics)
+
+    if replay is not None:
+        dialogs = load_dialogs(replay)
+    else:
+        template = json.loads(TEMPLATE_PATH.read_text(encoding="utf-8"))
+        rng = random.Random(seed)
+        dialogs = [
+            generate_dialog(app[application.QUESTS], template, f"user-{i}", rng, turns)
+            for i in range(dialog_count)
+        ]
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        return [
+            await run_level(
+                f"http://127.0.0.1:{port}/", dialogs, users, duration, level, metrics
+            )
+            for level, users in enumerate(levels)
+        ]
+    finally:
+        await runner.cleanup()
+
+
+def main() -> None:
+    parser = make_parser(__doc__.splitlines()[0])
+    parser.add_argument(
+        "--users", default="1,10,50,100", help="comma separated concurrency levels"
+    )
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per level")
+    parser.add_argument("--dialogs", type=int, default=1000)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=2023)
+    parser.add_argument("--replay", help="JSONL file of recorded Marusya requests")
+    args = parser.parse_args()
+
+    levels = [int(users) for users in args.users.split(",")]
+    results = asyncio.run(
+        run(levels, args.duration, args.dialogs, args.turns, args.seed, args.replay)
+    )
+    report(results, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Lookups per second of Stage.get_next_stage: list scans vs. phrase index.
+
+Run: PYTHONPATH=src python3 -m benchmarks.bench_matcher
+"""
+
+from typing import List, Optional, Tuple
+
+from skill_newyear_quest import quest
+
+from .timing import make_parser, measure, report
+
+
+def legacy_get_next_stage(stage: quest.Stage, user_response: str) -> quest.Stage:
+    # Implementation before the phrase index: split the utterance for every
+    # transition and scan the synonyms list word by word.
+    if stage.is_unconditional():
+        return quest.STAGES_DICTIONARY[stage.default_transition]
+    for transition in stage.transitions:
+        for word in user_response.split(" "):
+            if word in transition.synonims:
+                return quest.STAGES_DICTIONARY[transition.to_id]
+    return quest.STAGES_DICTIONARY[stage.default_transition]
+
+
+def build_corpus(misses: bool) -> List[Tuple[quest.Stage, str]]:
+    corpus: List[Tuple[quest.Stage, str]] = []
+    for stage in quest.STAGES_DICTIONARY.values():
+        if stage.transitions is None:
+            continue
+        if misses:
+            corpus.append((stage, "я не знаю что тут можно сказать"))
+            continue
+        for transition in stage.transitions:
+            for synonim in transition.synonims:
+                corpus.append((stage, synonim))
+                corpus.append((stage, f"я думаю что наверное {synonim}"))
+    return corpus
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = make_parser(__doc__).parse_args(argv)
+    quest.init("https://localhost/{file_name}.mp3")
+    results = []
+    for kind, misses in (("hits", False), ("misses", True)):
+        corpus = build_corpus(misses) * 20
+
+        def run_legacy():
+            for stage, text in corpus:
+                legacy_get_next_stage(stage, text)
+
+        def run_index():
+            for stage, text in corpus:
+                stage.get_next_stage(text)
+
+        results.append(
+            measure(f"{kind}: list scan", run_legacy, len(corpus), args.repeat)
+        )
+        results.append(
+            measure(f"{kind}: phrase index", run_index, len(corpus), args.repeat)
+        )
+
+    report(results, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Throughput of utils.prepare_phrase: char loop vs. translation table.
+
+Run: PYTHONPATH=src python3 -m benchmarks.bench_normalizer [--corpus FILE]
+"""
+
+from typing import List, Optional
+
+from skill_newyear_quest import utils
+
+from .corpus import load_utterances
+from .timing import make_parser, measure, report
+
+LEGACY_NOT_LETTERS = [",", ".", "!", "?"]
+
+
+def legacy_prepare_phrase(phrase) -> str:
+    result = ""
+    for symbol in phrase:
+        if symbol not in LEGACY_NOT_LETTERS:
+            result += symbol
+    return result.replace("ё", "е").lower()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = make_parser(__doc__)
+    parser.add_argument("--corpus", help="JSONL file with requests to replay")
+    args = parser.parse_args(argv)
+    corpus = load_utterances(args.corpus)
+
+    def run_legacy():
+        for text in corpus:
+            legacy_prepare_phrase(text)
+
+    def run_table():
+        for text in corpus:
+            utils.prepare_phrase(text)
+
+    report(
+        [
+            measure("prepare_phrase[char loop]", run_legacy, len(corpus), args.repeat),
+            measure("prepare_phrase[translate]", run_table, len(corpus), args.repeat),
+        ],
+        args.json,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Cost of encoding a stage answer: full json.dumps vs. spliced payload.
+
+Run: PYTHONPATH=src python3 -m benchmarks.bench_serialization
+"""
+
+import json
+import tracemalloc
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from skill_newyear_quest import quest, serialization, utils
+
+from .timing import make_parser, measure, report
+
+BASE_REQUEST = Path(__file__).parent.parent / "tests" / "base_request.json"
+
+
+def make_responses(request: Dict, payload: bool) -> List[Dict]:
+    result = []
+    for stage_id in quest.STAGES_DICTIONARY:
+        stage_response = quest.get_stage_response(stage_id)
+        response: Dict = {
+            "version": request["version"],
+            "session": request["session"],
+            "response": {"end_session": False},
+        }
+        if payload:
+            response["response"] = stage_response.payload
+        else:
+            utils.set_response(
+                response,
+                text_and_tts=(stage_response.text, stage_response.tts),
+                buttons=stage_response.buttons,
+            )
+        result.append(response)
+    return result
+
+
+def allocated_bytes(func) -> int:
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = make_parser(__doc__).parse_args(argv)
+    quest.init("https://localhost/{file_name}.mp3")
+    with BASE_REQUEST.open() as f:
+        request = json.load(f)
+
+    plain = make_responses(request, payload=False) * 20
+    spliced = make_responses(request, payload=True) * 20
+
+    def run_json_dumps():
+        # What web.json_response does for every answer
+        for response in plain:
+            json.dumps(response).encode("utf-8")
+
+    def run_spliced():
+        for response in spliced:
+            serialization.dumps_response(response)
+
+    results = [
+        measure("json.dumps(response)", run_json_dumps, len(plain), args.repeat),
+        measure(
+            f"dumps_response[orjson={serialization.orjson is not None}]",
+            run_spliced,
+            len(spliced),
+            args.repeat,
+        ),
+    ]
+    results[0]["peak_alloc_bytes"] = allocated_bytes(run_json_dumps)
+    results[1]["peak_alloc_bytes"] = allocated_bytes(run_spliced)
+    report(results, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Memory per session: dict-based sessions vs. compact __slots__ records.
+
+User id strings are created beforehand and are not part of the numbers.
+
+Run: PYTHONPATH=src python3 -m benchmarks.bench_session_memory [--count N]
+"""
+
+import gc
+import json
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+from skill_newyear_quest import sessions
+
+from .timing import make_parser
+
+
+class LegacyUserSession:
+    # Session layout before __slots__: instance __dict__ plus an info dict
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.info = {"current_state": 1, "current_stage": str(306 + len(session_id))}
+        self.last_time = time.time()
+
+
+def make_user_ids(count: int) -> List[str]:
+    return [f"{i:064x}" for i in range(count)]
+
+
+def bytes_per_session(user_ids: List[str], factory: Callable) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    store: Dict = {}
+    for user_id in user_ids:
+        store[user_id] = factory(user_id)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (after - before) / len(user_ids)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = make_parser(__doc__)
+    parser.add_argument("--count", type=int, default=1000000)
+    args = parser.parse_args(argv)
+    user_ids = make_user_ids(args.count)
+
+    def compact(user_id):
+        return sessions.UserSession(user_id, sessions.State.QUEST, len(user_id))
+
+    results = [
+        {
+            "name": name,
+            "sessions": args.count,
+            "bytes_per_session": bytes_per_session(user_ids, factory),
+        }
+        for name, factory in (("dict session", LegacyUserSession), ("slots", compact))
+    ]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(
+                f"{result['name']:<20} {result['sessions']:>10,} sessions"
+                f" {result['bytes_per_session']:>8.1f} bytes/session"
+            )
+
+
+if __name__ == "__main__":
+    main()
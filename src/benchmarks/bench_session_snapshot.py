@@ -0,0 +1,63 @@
+"""Session snapshot size, write time and load time.
+
+Run: PYTHONPATH=src python3 -m benchmarks.bench_session_snapshot [--count N]
+"""
+
+import json
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from skill_newyear_quest import session_journal, sessions
+
+from .timing import make_parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = make_parser(__doc__)
+    parser.add_argument("--count", type=int, default=1000000)
+    args = parser.parse_args(argv)
+
+    records = {
+        f"{i:064x}": sessions.UserSession(
+            f"{i:064x}", sessions.State.QUEST, i % 60, 1.6e9 + i
+        )
+        for i in range(args.count)
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        journal = session_journal.SessionJournal(directory, sessions.UserSession)
+        journal.load()
+
+        start = time.perf_counter()
+        journal._write_snapshot(journal.generation + 1, list(records.items()), [])
+        write_seconds = time.perf_counter() - start
+
+        size = (Path(directory) / session_journal.SNAPSHOT_FILE_NAME).stat().st_size
+
+        start = time.perf_counter()
+        loaded = session_journal.SessionJournal(directory, sessions.UserSession).load()
+        load_seconds = time.perf_counter() - start
+        assert len(loaded) == args.count
+
+    result = {
+        "sessions": args.count,
+        "snapshot_bytes": size,
+        "bytes_per_session": size / args.count,
+        "write_seconds": write_seconds,
+        "load_seconds": load_seconds,
+    }
+    if args.json:
+        print(json.dumps([result], indent=2))
+    else:
+        for key, value in result.items():
+            print(
+                f"{key:<20} {value:,.3f}"
+                if isinstance(value, float)
+                else f"{key:<20} {value:,}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import json
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from skill_newyear_quest import phrases, quest
+
+SAMPLE_UTTERANCES = [
+    "Включи скилл «Новогодний квест»!",
+    "Да, давай!",
+    "Ну... наверное, звездочёт?",
+    "Библиотека. Точно библиотека!",
+    "Хм, историю — расскажи историю.",
+    "Я думаю: «бежать в лес».",
+    "Шесть!",
+    "Ковёр-самолёт, конечно же",
+    "Повтори, пожалуйста, ещё раз?",
+    "Стоп.",
+]
+
+
+def _texts_from_record(record) -> Iterator[str]:
+    if isinstance(record, str):
+        yield record
+    elif isinstance(record, dict):
+        request = record.get("request")
+        if isinstance(request, dict):
+            text = request.get("command") or request.get("payload", {}).get("text")
+            if text:
+                yield text
+            return
+        for value in record.values():
+            if isinstance(value, str):
+                yield value
+
+
+def load_utterances(path: Optional[str] = None) -> List[str]:
+    """Utterances for text benchmarks.
+
+    With a path, every line of the JSONL file is replayed: Marusya requests
+    contribute their command, any other record contributes its string fields.
+    Without a path, the built-in samples plus all quest synonyms are used.
+    """
+    if path is not None:
+        result: List[str] = []
+        with Path(path).open(encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    result.extend(_texts_from_record(json.loads(line)))
+        return result
+
+    if not quest.STAGES_DICTIONARY:
+        quest.init("https://localhost/{file_name}.mp3")
+
+    result = list(SAMPLE_UTTERANCES)
+    for stage in quest.STAGES_DICTIONARY.values():
+        for transition in stage.transitions or []:
+            result.append(transition.main_text[0])
+            result.extend(transition.synonims)
+    result.extend(phrases.NOT_EXIT_PHRASES)
+    return result
@@ -0,0 +1,71 @@
+import argparse
+import json
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+_FIELDS = ("name", "operations", "seconds", "ops_per_sec", "ns_per_op")
+
+
+def measure(
+    name: str,
+    func: Callable[..., Any],
+    operations: int = 1,
+    repeat: int = 5,
+    setup: Optional[Callable[[], Any]] = None,
+) -> Dict:
+    """Run func repeat times and report the best run.
+
+    operations is the number of logical operations a single call performs, so
+    the result is comparable between functions working on batches of
+    different sizes. With setup, every run calls func(setup()) and only func
+    is timed, for functions that consume their input.
+    """
+    if setup is None:
+        func()
+    best = None
+    for _ in range(repeat):
+        if setup is None:
+            start = time.perf_counter()
+            func()
+        else:
+            state = setup()
+            start = time.perf_counter()
+            func(state)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    best_time: float = best if best else 1e-9
+    return {
+        "name": name,
+        "operations": operations,
+        "seconds": best_time,
+        "ops_per_sec": operations / best_time,
+        "ns_per_op": best_time * 1e9 / operations,
+    }
+
+
+def make_parser(description: str) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--json", action="store_true", help="print machine-readable results"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser
+
+
+def report(results: List[Dict], as_json: bool = False) -> None:
+    if as_json:
+        json.dump(results, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+        return
+
+    for result in results:
+        extra = "".join(
+            f" {key}={value}" for key, value in result.items() if key not in _FIELDS
+        )
+        print(
+            f"{result['name']:<40} {result['ops_per_sec']:>14,.0f} ops/s"
+            f" {result['ns_per_op']:>12,.1f} ns/op{extra}"
+        )
@@ -1,93 +1,233 @@
 import asyncio
 import configparser
+import json
 import logging
-import os
-import os.path
 import random
+import time
 import traceback
 from pathlib import Path
 from typing import Dict, Optional
 
 from aiohttp import web
 
-from . import graphite_statistics, phrases, quest, sessions, utils
-
-logging.basicConfig(level=logging.DEBUG)
-logging.info("Start newyear_quest_skill")
+from . import (
+    audio_manifest,
+    graphite_statistics,
+    intents,
+    marusya_request,
+    phrases,
+    quest,
+    registry,
+    serialization,
+    session_store,
+    sessions,
+    structured_logging,
+    turns,
+    utils,
+)
 
 PACKAGE_DIR = Path(__file__).parent
 
-config_paths = [
+CONFIG_PATHS = [
     Path("/config/skill_config.cfg"),
     PACKAGE_DIR.parent.parent / "skill_config.cfg",
 ]
 
-SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
-config = configparser.ConfigParser()
-is_found: bool = False
-for config_path in config_paths:
-    if config_path.exists():
-        config.read(config_path)
-        is_found = True
-        break
-
-if not is_found:
-    raise Exception(f"Config not found in {config_paths}")
+QUEST_SECTION_PREFIX = "quest:"
+DEFAULT_QUEST_PATHS = ["/", "/skill_newyear_quest"]
 
 
-HOST_IP = config.get("main", "host")
-HOST_PORT = int(config.get("main", "port"))
-SESSION_LIFE_TIME_SEC = int(config.get("main", "session_life_time_sec"))
-AUDIO_FILES_PATH = config.get("main", "audio_files_path")
+def load_config(config_paths=CONFIG_PATHS) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    for config_path in config_paths:
+        if config_path.exists():
+            config.read(config_path)
+            return config
 
-GRAPHITE_HOST = config.get("graphite", "host")
-GRAPHITE_PREFIX = config.get("graphite", "prefix")
-GRAPHITE_INTERVAL = int(config.get("graphite", "interval"))
+    raise Exception(f"Config not found in {config_paths}")
 
-graphite_sender = graphite_statistics.GraphiteSender(GRAPHITE_HOST, GRAPHITE_PREFIX)
 
-STATE_HELLO = 0
-STATE_QUEST = 1
-STATE_QUEST_COMPLETED = 2
-STATE_HAVE_SAVED_QEUSTION = 3
+class Settings:
+    """Options of skill_config.cfg used by the application."""
+
+    def __init__(self, config: configparser.ConfigParser) -> None:
+        self.host_ip = config.get("main", "host")
+        self.host_port = int(config.get("main", "port"))
+        # Larger request bodies are rejected with 413
+        self.max_body_size = int(config.get("main", "max_body_size", fallback="65536"))
+        # Worker processes of the launcher, 0 - one per CPU
+        self.workers = int(config.get("main", "workers", fallback="1"))
+        # Responses kept for the repeated messages, size 0 - not kept
+        self.response_cache_ttl_sec = float(
+            config.get("main", "response_cache_ttl_sec", fallback="30")
+        )
+        self.response_cache_size = int(
+            config.get("main", "response_cache_size", fallback="10000")
+        )
+        self.session_life_time_sec = int(config.get("main", "session_life_time_sec"))
+        self.session_expiry_interval_sec = int(
+            config.get("main", "session_expiry_interval_sec", fallback="10")
+        )
+        self.audio_files_path = config.get("main", "audio_files_path")
+        self.quest_path = config.get("main", "quest_path", fallback="") or None
+        # Compiled quests are pickled there, empty - not cached
+        self.quest_cache_dir = (
+            config.get("main", "quest_cache_dir", fallback="") or None
+        )
+
+        self.sessions_backend = config.get("sessions", "backend", fallback="memory")
+        self.sessions_path = config.get("sessions", "path", fallback="sessions.sqlite3")
+        self.sessions_url = config.get(
+            "sessions", "url", fallback="redis://127.0.0.1:6379/0"
+        )
+        self.sessions_key_prefix = config.get(
+            "sessions", "key_prefix", fallback="newyear_quest:"
+        )
+        self.sessions_max_count = int(
+            config.get("sessions", "max_sessions", fallback="0")
+        )
+        # Longest wait for a reply of the redis server
+        self.sessions_timeout_sec = float(
+            config.get("sessions", "timeout_sec", fallback="5")
+        )
+        self.sessions_snapshot_dir = config.get("sessions", "snapshot_dir", fallback="")
+        self.sessions_snapshot_interval_sec = int(
+            config.get("sessions", "snapshot_interval_sec", fallback="300")
+        )
+        self.sessions_journal_flush_interval_sec = float(
+            config.get("sessions", "journal_flush_interval_sec", fallback="1")
+        )
+
+        self.log_level = config.get("logging", "level", fallback="INFO")
+        # json or text
+        self.log_format = config.get("logging", "format", fallback="text")
+        # Share of requests logged with the full request and response
+        self.log_payload_rate = float(
+            config.get("logging", "payload_rate", fallback="0")
+        )
+
+        self.graphite_host = config.get("graphite", "host")
+        self.graphite_port = int(config.get("graphite", "port", fallback="2003"))
+        # tcp or udp
+        self.graphite_protocol = config.get("graphite", "protocol", fallback="tcp")
+        self.graphite_prefix = config.get("graphite", "prefix")
+        self.graphite_interval = int(config.get("graphite", "interval"))
+
+        # Audio files fetched at startup, see audio_manifest.py
+        self.audio_check = config.getboolean("audio", "check", fallback=False)
+        # URL template of a stand-in with the same files, empty - the real URLs
+        self.audio_check_url = config.get("audio", "check_url", fallback="") or None
+        self.audio_check_concurrency = int(
+            config.get("audio", "concurrency", fallback="16")
+        )
+        self.audio_timeout_sec = float(config.get("audio", "timeout_sec", fallback="5"))
+        self.audio_max_response_sec = float(
+            config.get("audio", "max_response_sec", fallback="120")
+        )
+
+
+# Per application state, the handlers read it from request.app
+SETTINGS = web.AppKey("settings", Settings)
+QUESTS = web.AppKey("quests", registry.QuestRegistry)
+# Metrics sink: inc(name, value=1), timing(name, seconds) and summary()
+METRICS = web.AppKey("metrics", object)
+# Metrics sender created by create_app, started and stopped with the app
+OWN_METRICS = web.AppKey("own_metrics", bool)
+# Per user locks and the recent responses for the repeated messages
+LOCKS = web.AppKey("locks", turns.UserLocks)
+RESPONSES = web.AppKey("responses", turns.ResponseCache)
+
+STATE_HELLO = sessions.State.HELLO
+STATE_QUEST = sessions.State.QUEST
+STATE_QUEST_COMPLETED = sessions.State.QUEST_COMPLETED
+STATE_HAVE_SAVED_QEUSTION = sessions.State.HAVE_SAVED_QUESTION
 
 
 async def marusya_newyear_quest(request_data) -> web.Response:
-    global graphite_sender
+    quest_registry = request_data.app[QUESTS]
+    metrics = request_data.app[METRICS]
+    spans = graphite_statistics.Spans(metrics)
+    body = await request_data.read()
+    try:
+        request = marusya_request.decode(body)
+    except marusya_request.RequestError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    spans.mark("span.parse")
+    responses = request_data.app[RESPONSES]
+    session_id = request.session.get("session_id")
+    repeated = responses.get(session_id, request.message_id)
+    if repeated is not None:
+        metrics.inc("requests_repeated")
+        return repeated_response(repeated)
+
+    current_quest = quest_registry.resolve(request.skill_id, request_data.path)
+    session_key = quest_registry.session_key(current_quest, request.user_id)
+    # Turns of one user run one at a time, so a retry delivered while the
+    # original request is still answered waits for it and is deduplicated
+    async with request_data.app[LOCKS].hold(session_key):
+        repeated = responses.get(session_id, request.message_id)
+        if repeated is not None:
+            metrics.inc("requests_repeated")
+            return repeated_response(repeated)
+        http_response = await answer(
+            request_data, request, body, current_quest, session_key, spans
+        )
+        responses.put(session_id, request.message_id, http_response.body)
+    return http_response
+
+
+def repeated_response(body: bytes) -> web.Response:
+    return web.Response(body=body, content_type="application/json", charset="utf-8")
+
+
+async def answer(
+    request_data,
+    request: marusya_request.SkillRequest,
+    body: bytes,
+    current_quest: quest.Quest,
+    session_key: str,
+    spans: graphite_statistics.Spans,
+) -> web.Response:
+    """Advance the quest of the user by one turn and build the response."""
     clear_session = False
-    request = await request_data.json()
-    logging.info(f"Request: \n {request}\n\n")
-
     response = {}
-    response["version"] = request["version"]
-    response["session"] = request["session"]
+    response["version"] = request.version
+    response["session"] = request.session
     response["response"] = {"end_session": False}
-    user_session = sessions.get_session(request["session"]["user_id"])
-
-    if request["session"]["new"]:
-        if "current_state" in user_session.info and (
-            user_session.info["current_state"] == STATE_QUEST
-            or user_session.info["current_state"] == STATE_HAVE_SAVED_QEUSTION
+    user_session = await sessions.get_session(session_key)
+    spans.mark("span.session")
+    stage_id: Optional[str] = None
+    intent: Optional[intents.Intent] = None
+
+    if request.new:
+        if (
+            user_session.state == STATE_QUEST
+            or user_session.state == STATE_HAVE_SAVED_QEUSTION
         ):
             utils.set_response(
                 response,
                 text_and_tts=random.choice(phrases.HAVE_SAVED_PHRASES),
                 buttons=phrases.HAVE_SAVED_BUTTONS,
             )
-            user_session.info["current_state"] = STATE_HAVE_SAVED_QEUSTION
+            user_session.state = STATE_HAVE_SAVED_QEUSTION
         else:
             utils.set_response(
                 response,
                 text_and_tts=random.choice(phrases.HELLO_PHRASES),
                 buttons=phrases.HELLO_BUTTONS,
             )
-            user_session.info["current_state"] = STATE_HELLO
+            user_session.state = STATE_HELLO
     else:
-        prepared_text: Optional[str] = utils.get_prepared_text(request)
+        # The text is normalized once: intents look up the joined words,
+        # the transition matcher walks the word list
+        words = request.words()
+        prepared_text: Optional[str] = None if words is None else " ".join(words)
 
         error_response = False
         if prepared_text is not None:
-            if prepared_text in phrases.STOP_PHRASES:
+            intent = intents.classify(prepared_text)
+            spans.mark("span.intent")
+            if intent & intents.Intent.STOP:
                 utils.set_response(
                     response, text_and_tts=random.choice(phrases.GOODBYE_PHRASES)
                 )
@@ -96,7 +236,7 @@ async def marusya_newyear_quest(request_data) -> web.Response:
             else:
                 try:
                     play_audio: bool = True
-                    current_state: int = user_session.info["current_state"]
+                    current_state: int = user_session.state
                     current_stage: Optional[quest.Stage] = None
 
                     # Start message answer
@@ -104,7 +244,7 @@ async def marusya_newyear_quest(request_data) -> web.Response:
                         current_state == STATE_HELLO
                         or current_state == STATE_QUEST_COMPLETED
                     ):
-                        if prepared_text not in phrases.NOT_EXIT_PHRASES:
+                        if not intent & intents.Intent.NOT_EXIT:
                             utils.set_response(
                                 response,
                                 text_and_tts=random.choice(phrases.GOODBYE_PHRASES),
@@ -112,83 +252,52 @@ async def marusya_newyear_quest(request_data) -> web.Response:
                             clear_session = True
                             response["response"]["end_session"] = True
                         else:
-                            current_stage = quest.get_root_stage()
-                            user_session.info["current_state"] = STATE_QUEST
+                            current_stage = current_quest.get_root_stage()
+                            user_session.state = STATE_QUEST
                     elif current_state == STATE_HAVE_SAVED_QEUSTION:
-                        if prepared_text in phrases.HAVE_SAVED_ANSWERS_NEW:
-                            current_stage = quest.get_root_stage()
-                            user_session.info["current_state"] = STATE_QUEST
-                        elif prepared_text in phrases.HAVE_SAVED_ANSWERS_EXIT:
+                        if intent & intents.Intent.HAVE_SAVED_NEW:
+                            current_stage = current_quest.get_root_stage()
+                            user_session.state = STATE_QUEST
+                        elif intent & intents.Intent.HAVE_SAVED_EXIT:
                             utils.set_response(
                                 response,
                                 text_and_tts=random.choice(phrases.GOODBYE_PHRASES),
                             )
                             response["response"]["end_session"] = True
                         else:
-                            current_stage = quest.get_stage_by_id(
-                                user_session.info["current_stage"]
+                            current_stage = current_quest.get_stage_by_index(
+                                user_session.stage
                             )
-                            user_session.info["current_state"] = STATE_QUEST
+                            user_session.state = STATE_QUEST
                     else:
-                        if prepared_text in phrases.SIMPLE_REPEAT_PHRASES:
-                            current_stage = quest.get_stage_by_id(
-                                user_session.info["current_stage"]
+                        if intent & intents.Intent.SIMPLE_REPEAT:
+                            current_stage = current_quest.get_stage_by_index(
+                                user_session.stage
                             )
                             play_audio = False
-                        elif prepared_text in phrases.FULL_REPEAT_PHRASES:
-                            current_stage = quest.get_stage_by_id(
-                                user_session.info["current_stage"]
+                        elif intent & intents.Intent.FULL_REPEAT:
+                            current_stage = current_quest.get_stage_by_index(
+                                user_session.stage
                             )
                         else:
-                            current_stage = quest.get_stage_by_id(
-                                user_session.info["current_stage"]
-                            ).get_next_stage(prepared_text)
+                            current_stage, matched = current_quest.get_stage_by_index(
+                                user_session.stage
+                            ).match_next_stage(prepared_text, words)
+                            spans.mark("match.matched" if matched else "match.default")
 
                     if not response["response"]["end_session"]:
-                        response_text_and_tts = ["", ""]
-
                         if current_stage is not None:
-                            current_stage_strong: quest.Stage = current_stage
-                            current_stage_strong.add_response_text_and_tts(
-                                response_text_and_tts, play_audio
+                            stage_response = current_quest.get_stage_response(
+                                current_stage.id, play_audio
                             )
 
-                            while (
-                                current_stage_strong.is_unconditional()
-                                and not current_stage_strong.is_end()
-                            ):
-
-                                current_stage = current_stage_strong.get_next_stage()
-                                if current_stage is not None:
-                                    current_stage_strong = current_stage
-                                    current_stage_strong.add_response_text_and_tts(
-                                        response_text_and_tts, play_audio
-                                    )
-
-                            buttons = current_stage_strong.buttons
-
-                            if current_stage_strong.is_end():
-                                response_text_and_tts[
-                                    0
-                                ] += f"\n{phrases.QUEST_COMPLETE_PHRASE[0]}"
-                                response_text_and_tts[1] += (
-                                    "\n" + phrases.QUEST_COMPLETE_PHRASE[1]
-                                )
-                                buttons = phrases.EXIT_QUESTION_BUTTONS
-                                user_session.info[
-                                    "current_state"
-                                ] = STATE_QUEST_COMPLETED
+                            if stage_response.is_end:
+                                user_session.state = STATE_QUEST_COMPLETED
 
-                            utils.set_response(
-                                response,
-                                text_and_tts=(
-                                    str(response_text_and_tts[0]),
-                                    response_text_and_tts[1],
-                                ),
-                                buttons=buttons,
-                            )
+                            response["response"] = stage_response.payload
 
-                            user_session.info["current_stage"] = current_stage_strong.id
+                            user_session.stage = stage_response.stage_index
+                            stage_id = stage_response.stage_id
                         else:
                             error_response = True
 
@@ -210,19 +319,64 @@ async def marusya_newyear_quest(request_data) -> web.Response:
         # if response["response"]["end_session"]:
         #    user_session.remove()
 
-    logging.info(f"Response: \n {response}\n\n")
+    spans.mark("span.response")
     if clear_session:
-        user_session.remove()
+        await user_session.remove()
     else:
-        user_session.update()
-    return web.json_response(response)
+        await user_session.update()
+    spans.mark("span.save")
+    http_response = serialization.json_response(response)
+    spans.mark("span.serialize")
+    if stage_id is not None:
+        spans.total(f"stage.{stage_id}")
+
+    structured_logging.log_request(
+        request.user_id,
+        stage_id,
+        None if intent is None else int(intent),
+        spans.started,
+    )
+    if structured_logging.is_sampled(request_data.app[SETTINGS].log_payload_rate):
+        logging.info(
+            "payload",
+            extra={
+                "fields": {
+                    "request": serialization.loads(body),
+                    "response": json.loads(http_response.body),
+                }
+            },
+        )
+    return http_response
 
 
 async def get_main(request_data) -> web.StreamResponse:
-    graphite_sender.inc("query_get")
+    request_data.app[METRICS].inc("query_get")
     return web.json_response({"status": "OK", "tag": "4"})
 
 
+async def get_metrics(request_data) -> web.StreamResponse:
+    return web.json_response(request_data.app[METRICS].summary())
+
+
+def route_metric_name(request) -> str:
+    resource = request.match_info.route.resource
+    if resource is None:
+        return "route.unmatched"
+    path = resource.canonical.strip("/").replace("/", "_").replace(".", "_")
+    return f"route.{request.method.lower()}.{path or 'root'}"
+
+
+@web.middleware
+async def timing_middleware(request, handler) -> web.StreamResponse:
+    started = time.perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        request.app[METRICS].timing(
+            route_metric_name(request), time.perf_counter() - started
+        )
+
+
 async def get_readiness_probe(request_data) -> web.StreamResponse:
     return web.json_response(healthz())
 
@@ -239,29 +393,150 @@ def healthz() -> Dict:
     return {"status": "OK"}
 
 
-def init_app(loop) -> web.Application:
-    app = web.Application(loop=loop, client_max_size=100000000)
+def init_quests(
+    config: configparser.ConfigParser, settings: Optional[Settings] = None
+) -> registry.QuestRegistry:
+    """Default quest from [main] plus one quest per [quest:<name>] section."""
+    if settings is None:
+        settings = Settings(config)
+    quest_registry = registry.QuestRegistry()
+    quest.init(settings.audio_files_path, settings.quest_path, settings.quest_cache_dir)
+    assert quest.DEFAULT_QUEST is not None
+    quest_registry.add(quest.DEFAULT_QUEST, paths=DEFAULT_QUEST_PATHS, default=True)
+
+    for section in config.sections():
+        if not section.startswith(QUEST_SECTION_PREFIX):
+            continue
+        quest_registry.load(
+            section[len(QUEST_SECTION_PREFIX) :],
+            config.get(section, "audio_files_path", fallback=settings.audio_files_path),
+            config.get(section, "path"),
+            settings.quest_cache_dir,
+            skill_ids=config.get(section, "skill_ids", fallback="").split(),
+            paths=config.get(section, "paths", fallback="").split(),
+        )
+    intents.report_collisions()
+    return quest_registry
+
+
+async def start_sessions(app) -> None:
+    settings = app[SETTINGS]
+    metrics = app[METRICS]
+    sessions.init(
+        settings.session_life_time_sec,
+        session_store.create_store(
+            settings.sessions_backend,
+            settings.session_life_time_sec,
+            sessions.UserSession,
+            path=settings.sessions_path,
+            url=settings.sessions_url,
+            key_prefix=settings.sessions_key_prefix,
+            expiry_granularity=settings.session_expiry_interval_sec,
+            max_sessions=settings.sessions_max_count,
+            metrics=metrics,
+            snapshot_dir=settings.sessions_snapshot_dir,
+            journal_flush_interval=settings.sessions_journal_flush_interval_sec,
+            snapshot_interval=settings.sessions_snapshot_interval_sec,
+            timeout=settings.sessions_timeout_sec,
+        ),
+        settings.session_expiry_interval_sec,
+        metrics,
+    )
+    sessions.store.restore()
+    loop = asyncio.get_event_loop()
+    sessions.add_loop_task(loop)
+    if app[OWN_METRICS]:
+        metrics.start(settings.graphite_interval)
+
+
+async def check_audio(app) -> None:
+    settings = app[SETTINGS]
+    if settings.audio_check:
+        manifest = await audio_manifest.check_quests(app[QUESTS], settings)
+        app[METRICS].gauge("audio.broken", len(manifest.broken()))
+
+
+async def close_sessions(app) -> None:
+    await sessions.store.close()
+    if app[OWN_METRICS]:
+        app[METRICS].stop()
+
+
+def create_app(
+    config: Optional[configparser.ConfigParser] = None,
+    metrics=None,
+    quest_registry: Optional[registry.QuestRegistry] = None,
+) -> web.Application:
+    """Build the skill application; nothing is read or started on import.
+
+    config defaults to the first of CONFIG_PATHS. The quests are loaded
+    unless an already loaded registry is passed (the launcher loads them
+    once before fork). Sessions and the metrics task start with the app on
+    its event loop; an injected metrics sink is left to the caller.
+    """
+    if config is None:
+        config = load_config()
+    settings = Settings(config)
+    if quest_registry is None:
+        quest_registry = init_quests(config, settings)
+
+    app = web.Application(
+        client_max_size=settings.max_body_size, middlewares=[timing_middleware]
+    )
+    app[SETTINGS] = settings
+    app[QUESTS] = quest_registry
+    app[OWN_METRICS] = metrics is None
+    if metrics is None:
+        metrics = graphite_statistics.GraphiteSender(
+            settings.graphite_host,
+            settings.graphite_prefix,
+            settings.graphite_port,
+            settings.graphite_protocol,
+        )
+    app[METRICS] = metrics
+    app[LOCKS] = turns.UserLocks()
+    app[RESPONSES] = turns.ResponseCache(
+        settings.response_cache_ttl_sec, settings.response_cache_size
+    )
+
     app.router.add_post("/", marusya_newyear_quest)
     app.router.add_post("/skill_newyear_quest", marusya_newyear_quest)
     app.router.add_get("/", get_main)
     app.router.add_get("/skill_newyear_quest", get_main)
+    for path in quest_registry.paths:
+        if path not in DEFAULT_QUEST_PATHS:
+            app.router.add_post(path, marusya_newyear_quest)
+            app.router.add_get(path, get_main)
+    app.router.add_get("/metrics", get_metrics)
     app.router.add_get("/readiness_probe", get_readiness_probe)
     app.router.add_get("/liveness_probe", get_liveness_probe)
     app.router.add_get("/startup_probe", get_startup_probe)
+    app.on_startup.append(start_sessions)
+    app.on_startup.append(check_audio)
+    app.on_cleanup.append(close_sessions)
 
     return app
 
 
-loop = asyncio.get_event_loop()
-app = init_app(loop)
-quest.init(AUDIO_FILES_PATH)
+def run(app: web.Application, sock=None) -> None:
+    """Serve app until a stop signal, on its own port or on sock."""
+    settings = app[SETTINGS]
+    if sock is None:
+        web.run_app(app, host=settings.host_ip, port=settings.host_port)
+    else:
+        web.run_app(app, sock=sock)
 
 
-if __name__ == "__main__":
+def main() -> None:
+    config = load_config()
+    settings = Settings(config)
+    structured_logging.setup_logging(settings.log_level, settings.log_format == "json")
+    logging.info("Start newyear_quest_skill")
     try:
-        sessions.init(SESSION_LIFE_TIME_SEC)
-        sessions.add_loop_task(loop)
-        graphite_sender.add_loop_task(loop, GRAPHITE_INTERVAL)
-        web.run_app(app, host=HOST_IP, port=HOST_PORT)
+        run(create_app(config))
     except web.GracefulExit:
         print("server was stopped")
+
+
+if __name__ == "__main__":
+    main()
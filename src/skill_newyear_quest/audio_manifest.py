@@ -0,0 +1,260 @@
+"""Startup check of the quest audio: python3 -m skill_newyear_quest.audio_manifest
+
+Every stage with sound plays one mp3 from its <speaker audio_url=...> tag.
+The manifest lists the URLs once per process, fetches the start of every
+file concurrently over one pooled HTTP client (the production URLs or a
+local stand-in with the same file names) and reads the durations from the
+mp3 headers, so missing files and responses with too much audio are
+reported at deploy time.
+"""
+
+import asyncio
+import logging
+import struct
+import sys
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+# Bytes fetched from the start of a file, enough for the first frame header
+# and its Xing/Info tag unless an ID3 tag comes first
+PROBE_SIZE = 16384
+
+# Layer III bitrates in kbit/s by bitrate index, MPEG-1 and MPEG-2/2.5
+BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by version bits: 3 - MPEG-1, 2 - MPEG-2, 0 - MPEG-2.5
+SAMPLE_RATES = {
+    3: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    0: (11025, 12000, 8000),
+}
+
+
+class AudioAsset:
+    """One audio file and what the check found out about it."""
+
+    __slots__ = ("url", "check_url", "stage_ids", "size", "duration", "error")
+
+    def __init__(self, url: str, check_url: str) -> None:
+        self.url = url
+        self.check_url = check_url
+        self.stage_ids: List[str] = []
+        self.size: Optional[int] = None
+        # Seconds, None when the file is not checked or not an mp3
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+
+
+def id3_size(head: bytes) -> int:
+    """Length of the ID3v2 tag at the start of the file, 0 without one."""
+    if len(head) < 10 or head[:3] != b"ID3":
+        return 0
+    size = 0
+    for byte in head[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if head[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def mp3_duration(frames: bytes, audio_size: int) -> Optional[float]:
+    """Duration of Layer III audio starting with frames, audio_size bytes long.
+
+    The frame count of a Xing/Info tag gives the exact duration of a VBR
+    file; without one the file is taken as constant bitrate.
+    """
+    start = frames.find(b"\xff")
+    while 0 <= start <= len(frames) - 4:
+        header = frames[start : start + 4]
+        version = (header[1] >> 3) & 3
+        bitrate_index = header[2] >> 4
+        rate_index = (header[2] >> 2) & 3
+        if (
+            (header[1] & 0xE0) == 0xE0
+            and version != 1
+            and (header[1] >> 1) & 3 == 1
+            and 0 < bitrate_index < 15
+            and rate_index < 3
+        ):
+            break
+        start = frames.find(b"\xff", start + 1)
+    else:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = BITRATES[1 if mpeg1 else 2][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    samples = 1152 if mpeg1 else 576
+
+    mono = header[3] >> 6 == 3
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    tag = start + 4 + side_info
+    if frames[tag : tag + 4] in (b"Xing", b"Info") and len(frames) >= tag + 12:
+        flags, frame_count = struct.unpack(">II", frames[tag + 4 : tag + 12])
+        if flags & 1:
+            return frame_count * samples / sample_rate
+    return (audio_size - start) * 8 / bitrate
+
+
+def content_size(response: aiohttp.ClientResponse) -> Optional[int]:
+    if response.status == 206:
+        content_range = response.headers.get("Content-Range", "")
+        total = content_range.rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    return response.content_length
+
+
+async def read_prefix(
+    session: aiohttp.ClientSession, url: str, offset: int
+) -> Tuple[bytes, Optional[int]]:
+    """PROBE_SIZE bytes of url from offset and the size of the whole file."""
+    headers = {"Range": f"bytes={offset}-{offset + PROBE_SIZE - 1}"}
+    async with session.get(url, headers=headers) as response:
+        if response.status not in (200, 206):
+            raise ValueError(f"HTTP {response.status}")
+        if response.status == 200 and offset:
+            raise ValueError("range requests are not supported")
+        data = b""
+        while len(data) < PROBE_SIZE:
+            chunk = await response.content.read(PROBE_SIZE - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data, content_size(response)
+
+
+class AudioManifest:
+    """Audio files of the quests with the stages that play them."""
+
+    def __init__(self) -> None:
+        self.assets: Dict[str, AudioAsset] = {}
+        # (quest name, entry stage id) -> audio URLs of its response
+        self.responses: Dict[Tuple[str, str], List[str]] = {}
+
+    def add_quest(
+        self, current_quest, check_url_template: Optional[str] = None
+    ) -> None:
+        for stage_id, stage in current_quest.stages.items():
+            if stage.audio_url is not None:
+                asset = self.assets.get(stage.audio_url)
+                if asset is None:
+                    check_url = stage.audio_url
+                    if check_url_template:
+                        check_url = check_url_template.format(file_name=stage_id)
+                    asset = self.assets[stage.audio_url] = AudioAsset(
+                        stage.audio_url, check_url
+                    )
+                asset.stage_ids.append(f"{current_quest.name}:{stage_id}")
+
+            # The stages one response plays, as in Stage.build_response
+            urls = [] if stage.audio_url is None else [stage.audio_url]
+            while stage.is_unconditional():
+                stage = stage.get_next_stage()
+                if stage.audio_url is not None:
+                    urls.append(stage.audio_url)
+            if urls:
+                self.responses[(current_quest.name, stage_id)] = urls
+
+    @classmethod
+    def from_registry(
+        cls, quest_registry, check_url_template: Optional[str] = None
+    ) -> "AudioManifest":
+        manifest = cls()
+        for current_quest in quest_registry.quests.values():
+            manifest.add_quest(current_quest, check_url_template)
+        return manifest
+
+    async def probe(self, session: aiohttp.ClientSession, asset: AudioAsset) -> None:
+        try:
+            head, size = await read_prefix(session, asset.check_url, 0)
+            offset = id3_size(head)
+            frames = head[offset:]
+            # A long ID3 tag (cover art) pushes the first frame out of head
+            if offset and len(head) == PROBE_SIZE and len(frames) < PROBE_SIZE // 2:
+                frames, _ = await read_prefix(session, asset.check_url, offset)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            asset.error = str(e) or type(e).__name__
+            return
+        asset.size = size
+        if size is None:
+            asset.error = "unknown size"
+            return
+        asset.duration = mp3_duration(frames, size - offset)
+        if asset.duration is None:
+            asset.error = "no mp3 frame"
+
+    async def check(self, concurrency: int = 16, timeout: float = 5.0) -> None:
+        """Fetch the start of every file, at most concurrency at a time."""
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as session:
+            await asyncio.gather(
+                *[self.probe(session, asset) for asset in self.assets.values()]
+            )
+
+    def response_duration(self, urls: List[str]) -> Optional[float]:
+        durations = [self.assets[url].duration for url in urls]
+        if any(duration is None for duration in durations):
+            return None
+        return sum(durations)  # type: ignore
+
+    def long_responses(self, max_seconds: float) -> List[Tuple[str, str, float]]:
+        """(quest name, entry stage id, seconds) of responses over the limit."""
+        found = []
+        for (name, stage_id), urls in self.responses.items():
+            duration = self.response_duration(urls)
+            if duration is not None and duration > max_seconds:
+                found.append((name, stage_id, duration))
+        return found
+
+    def broken(self) -> List[AudioAsset]:
+        return [asset for asset in self.assets.values() if asset.error is not None]
+
+    def report(self, max_seconds: float) -> int:
+        """Log the broken files and the long responses, return how many."""
+        broken = self.broken()
+        for asset in broken:
+            logging.warning(
+                f"Audio {asset.check_url} of stages {', '.join(asset.stage_ids)}"
+                f" is broken: {asset.error}"
+            )
+        long_responses = self.long_responses(max_seconds)
+        for name, stage_id, duration in long_responses:
+            logging.warning(
+                f"Quest {name}: response of stage {stage_id} plays {duration:.1f} s"
+                f" of audio, the limit is {max_seconds:g} s"
+            )
+        total = sum(asset.duration or 0.0 for asset in self.assets.values())
+        logging.info(
+            f"{len(self.assets)} audio files checked, {len(broken)} broken,"
+            f" {total:.0f} s of audio"
+        )
+        return len(broken) + len(long_responses)
+
+
+async def check_quests(quest_registry, settings) -> AudioManifest:
+    manifest = AudioManifest.from_registry(quest_registry, settings.audio_check_url)
+    await manifest.check(settings.audio_check_concurrency, settings.audio_timeout_sec)
+    manifest.report(settings.audio_max_response_sec)
+    return manifest
+
+
+def main() -> None:
+    from . import application, structured_logging
+
+    config = application.load_config()
+    settings = application.Settings(config)
+    structured_logging.setup_logging(settings.log_level, settings.log_format == "json")
+    quest_registry = application.init_quests(config, settings)
+    manifest = asyncio.run(check_quests(quest_registry, settings))
+    problems = manifest.broken() or manifest.long_responses(
+        settings.audio_max_response_sec
+    )
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,224 @@
-import asyncio
 import logging
-from typing import Dict
+import math
+import socket
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 
-import graphyte  # type: ignore
+# Histogram buckets of microseconds grow by 2 ** (1 / HISTOGRAM_BUCKETS_PER_OCTAVE),
+# so a percentile is off by less than 5%
+HISTOGRAM_BUCKETS_PER_OCTAVE = 8
+HISTOGRAM_BUCKETS = 40 * HISTOGRAM_BUCKETS_PER_OCTAVE
+PERCENTILES = (50, 95, 99)
+
+# Datagram payload that is not fragmented on common networks
+UDP_PAYLOAD_SIZE = 1400
+
+
+class Histogram:
+    """Log-linear histogram of non-negative values.
+
+    Only the event loop thread writes it, the flush thread reads copies of
+    the cumulative buckets and works with the differences.
+    """
+
+    __slots__ = ("buckets", "total")
+
+    def __init__(self) -> None:
+        self.buckets: List[int] = [0] * HISTOGRAM_BUCKETS
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.total += value
+        if value < 1.0:
+            index = 0
+        else:
+            index = int(math.log2(value) * HISTOGRAM_BUCKETS_PER_OCTAVE)
+            if index >= HISTOGRAM_BUCKETS:
+                index = HISTOGRAM_BUCKETS - 1
+        self.buckets[index] += 1
+
+
+def bucket_value(index: int) -> float:
+    # Geometric middle of the bucket
+    return 2.0 ** ((index + 0.5) / HISTOGRAM_BUCKETS_PER_OCTAVE)
+
+
+def percentiles(buckets: List[int], count: int) -> List[float]:
+    values = []
+    targets = [math.ceil(count * percent / 100) for percent in PERCENTILES]
+    seen = 0
+    index = 0
+    for target in targets:
+        while seen + buckets[index] < target:
+            seen += buckets[index]
+            index += 1
+        values.append(bucket_value(index))
+    return values
+
+
+def histogram_stats(buckets: List[int], total: float) -> Dict[str, float]:
+    """count, mean and percentiles in milliseconds of microsecond buckets."""
+    count = sum(buckets)
+    stats: Dict[str, float] = {"count": count}
+    if count:
+        stats["mean"] = total / count / 1000.0
+        for percent, value in zip(PERCENTILES, percentiles(buckets, count)):
+            stats[f"p{percent}"] = value / 1000.0
+    return stats
+
+
+class Spans:
+    """Consecutive parts of one request, each recorded as a timer."""
+
+    __slots__ = ("metrics", "started", "last")
+
+    def __init__(self, metrics) -> None:
+        self.metrics = metrics
+        self.started = self.last = time.perf_counter()
+
+    def mark(self, name) -> None:
+        """Time since the previous mark (or the start) goes to name."""
+        now = time.perf_counter()
+        self.metrics.timing(name, now - self.last)
+        self.last = now
+
+    def total(self, name) -> None:
+        self.metrics.timing(name, time.perf_counter() - self.started)
 
 
 class GraphiteSender:
-    def __init__(self, host, prefix) -> None:
-        self.sender: graphyte.Sender = graphyte.Sender(host, prefix=prefix)
-        self.is_runned: bool = False
-        self.start_collect()
-
-    def start_collect(self):
-        self.metrics: Dict = {}
-
-    def inc(self, name):
-        logging.info(f"Add metrics: {name}")
-        if name in self.metrics:
-            self.metrics[name] += 1
+    """Counters, gauges and timers sent to Graphite in the plaintext protocol.
+
+    Recording is a dict update on the event loop thread, nothing is locked
+    or logged. Counters and histograms only grow; a background thread
+    copies them every interval and sends the differences since the last
+    successful flush as one payload, so a failed send is not lost but
+    reported with the next one.
+    """
+
+    def __init__(
+        self, host, prefix, port: int = 2003, protocol: str = "tcp", timeout=5.0
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.protocol = protocol
+        self.timeout = timeout
+
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+        # State of the last successful flush, used by the flush thread only
+        self.sent_counters: Dict[str, float] = {}
+        self.sent_histograms: Dict[str, Tuple[List[int], float]] = {}
+
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    def inc(self, name, value=1):
+        counters = self.counters
+        counters[name] = counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def timing(self, name, seconds):
+        """Record a duration; it is reported in milliseconds."""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds * 1000000.0)
+
+    def collect(
+        self,
+    ) -> Tuple[List[str], Dict[str, float], Dict[str, Tuple[List[int], float]]]:
+        """Payload lines since the last flush plus the state to remember."""
+        timestamp = int(time.time())
+        prefix = f"{self.prefix}." if self.prefix else ""
+        lines = []
+
+        # Copying a dict or a list is atomic for the writing thread
+        counters = dict(self.counters)
+        for name, value in counters.items():
+            delta = value - self.sent_counters.get(name, 0)
+            lines.append(f"{prefix}{name} {delta} {timestamp}\n")
+
+        for name, value in dict(self.gauges).items():
+            lines.append(f"{prefix}{name} {value} {timestamp}\n")
+
+        histograms = {}
+        for name, histogram in dict(self.histograms).items():
+            buckets, total = list(histogram.buckets), histogram.total
+            histograms[name] = (buckets, total)
+            sent_buckets, sent_total = self.sent_histograms.get(name, (None, 0.0))
+            if sent_buckets is not None:
+                buckets = [now - sent for now, sent in zip(buckets, sent_buckets)]
+            for stat, value in histogram_stats(buckets, total - sent_total).items():
+                lines.append(f"{prefix}{name}.{stat} {value:g} {timestamp}\n")
+
+        return lines, counters, histograms
+
+    def summary(self) -> Dict[str, Dict]:
+        """Everything recorded since the start, timers in milliseconds."""
+        return {
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "timers": {
+                name: histogram_stats(list(histogram.buckets), histogram.total)
+                for name, histogram in dict(self.histograms).items()
+            },
+        }
+
+    def send(self, lines: List[str]) -> None:
+        if self.protocol == "udp":
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                datagram = b""
+                for line in lines:
+                    encoded = line.encode("utf-8")
+                    if datagram and len(datagram) + len(encoded) > UDP_PAYLOAD_SIZE:
+                        sock.sendto(datagram, (self.host, self.port))
+                        datagram = b""
+                    datagram += encoded
+                if datagram:
+                    sock.sendto(datagram, (self.host, self.port))
         else:
-            self.metrics[name] = 1
+            with socket.create_connection(
+                (self.host, self.port), timeout=self.timeout
+            ) as sock:
+                sock.sendall("".join(lines).encode("utf-8"))
 
-    def send_metrics(self):
-        for name, value in self.metrics.items():
-            self.sender.send(name, value)
+    def flush(self) -> None:
+        lines, counters, histograms = self.collect()
+        if not lines:
+            return
+        try:
+            self.send(lines)
+        except OSError as e:
+            logging.warning(f"Metrics are not sent to {self.host}:{self.port}: {e}")
+            return
+        self.sent_counters = counters
+        self.sent_histograms = histograms
 
-    async def send_task_async(self):
-        self.start_collect()
-        await asyncio.sleep(self.interval)
-        self.send_metrics()
-        if self.is_runned:
-            self.loop.create_task(self.send_task_async())
+    def flush_task(self, interval) -> None:
+        while not self.stopped.wait(interval):
+            self.flush()
+        self.flush()
 
-    def add_loop_task(self, loop, interval):
-        if self.is_runned:
+    def start(self, interval) -> None:
+        if self.thread is not None:
             raise Exception("Graphite client exception", "Send task is already runned")
 
-        self.loop = loop
-        self.is_runned = True
-        self.interval = interval
-        self.loop.create_task(self.send_task_async())
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self.flush_task, args=(interval,), name="metrics", daemon=True
+        )
+        self.thread.start()
 
-    def stop_loop_task(self):
-        self.is_runned = False
+    def stop(self) -> None:
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
@@ -0,0 +1,65 @@
+import enum
+import logging
+from typing import Dict, Iterable
+
+from . import phrases
+
+
+class Intent(enum.IntFlag):
+    NONE = 0
+    STOP = enum.auto()
+    NOT_EXIT = enum.auto()
+    SIMPLE_REPEAT = enum.auto()
+    FULL_REPEAT = enum.auto()
+    HAVE_SAVED_CONTINUE = enum.auto()
+    HAVE_SAVED_NEW = enum.auto()
+    HAVE_SAVED_EXIT = enum.auto()
+
+
+INTENT_PHRASES: Dict[Intent, Iterable[str]] = {
+    Intent.STOP: phrases.STOP_PHRASES,
+    Intent.NOT_EXIT: phrases.NOT_EXIT_PHRASES,
+    Intent.SIMPLE_REPEAT: phrases.SIMPLE_REPEAT_PHRASES,
+    Intent.FULL_REPEAT: phrases.FULL_REPEAT_PHRASES,
+    Intent.HAVE_SAVED_CONTINUE: phrases.HAVE_SAVED_ANSWERS_CONTINUE,
+    Intent.HAVE_SAVED_NEW: phrases.HAVE_SAVED_ANSWERS_NEW,
+    Intent.HAVE_SAVED_EXIT: phrases.HAVE_SAVED_ANSWERS_EXIT,
+}
+
+
+def build_table(groups: Dict[Intent, Iterable[str]]) -> Dict[str, Intent]:
+    """Merge prepared phrase groups into one phrase -> intent flags table.
+
+    A phrase that belongs to several groups gets all their flags, so the
+    handler can still pick the meaning that fits the current state.
+    Hyphenated phrases are also added split, as platform tokens have them.
+    """
+    table: Dict[str, Intent] = {}
+    for intent, group in groups.items():
+        for phrase in group:
+            forms = [phrase]
+            if "-" in phrase:
+                forms.append(" ".join(phrase.replace("-", " ").split()))
+            for form in forms:
+                table[form] = table.get(form, Intent.NONE) | intent
+    return table
+
+
+def find_collisions(table: Dict[str, Intent]) -> Dict[str, Intent]:
+    return {
+        phrase: intent
+        for phrase, intent in table.items()
+        if bin(int(intent)).count("1") > 1
+    }
+
+
+INTENTS_TABLE: Dict[str, Intent] = build_table(INTENT_PHRASES)
+
+
+def classify(prepared_text: str) -> Intent:
+    return INTENTS_TABLE.get(prepared_text, Intent.NONE)
+
+
+def report_collisions() -> None:
+    for phrase, intent in sorted(find_collisions(INTENTS_TABLE).items()):
+        logging.warning(f"Phrase '{phrase}' belongs to several intents: {intent!r}")
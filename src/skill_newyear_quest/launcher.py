@@ -0,0 +1,168 @@
+"""Pre-fork launcher of the skill: python3 -m skill_newyear_quest.launcher
+
+The parent reads the config and compiles the quests once and forks the
+workers, so the quest pages are shared copy-on-write. Every worker runs its
+own event loop, uvloop when it is installed, on its own socket bound with
+SO_REUSEPORT: the kernel spreads connections between the workers.
+"""
+
+import asyncio
+import gc
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Dict
+
+from . import application, structured_logging
+
+# Restarting a worker that keeps crashing more often than this is pointless
+RESTART_DELAY_SEC = 1.0
+
+# Retries are deduplicated and the turns of a user serialized per process,
+# and the shared session stores have no compare-and-set on a session
+# version yet: a retry that reaches another worker advances the quest again
+MAX_WORKERS = 1
+
+
+def install_uvloop() -> bool:
+    try:
+        import uvloop  # type: ignore
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def create_socket(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def worker_count(workers: int) -> int:
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+
+def usable_workers(workers: int, sessions_backend: str) -> int:
+    """Workers to start for the configured number, see MAX_WORKERS."""
+    if workers > 1 and sessions_backend == "memory":
+        # Requests of one user land on any worker, sessions must be shared
+        logging.warning(
+            "Memory sessions are not shared between workers, starting one worker;"
+            " use the sqlite or redis sessions backend for several workers"
+        )
+        return 1
+    if workers > MAX_WORKERS:
+        logging.warning(
+            f"{workers} workers requested, starting {MAX_WORKERS}: retries are"
+            " deduplicated per worker process only"
+        )
+        return MAX_WORKERS
+    return workers
+
+
+def run_worker(config, quest_registry, index: int, workers: int) -> None:
+    settings = application.Settings(config)
+    structured_logging.setup_logging(settings.log_level, settings.log_format == "json")
+    if workers > 1:
+        # Counters of every worker are a separate series, sum them in graphs
+        prefix = config.get("graphite", "prefix")
+        config.set("graphite", "prefix", f"{prefix}.worker{index}")
+        # The audio files are the same for all, one worker checks them
+        if index and config.has_section("audio"):
+            config.set("audio", "check", "false")
+    app = application.create_app(config, quest_registry=quest_registry)
+    logging.info(f"Worker {index} started, pid {os.getpid()}")
+    try:
+        application.run(app, create_socket(settings.host_ip, settings.host_port))
+    except application.web.GracefulExit:
+        pass
+
+
+def fork_worker(config, quest_registry, index: int, workers: int) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            run_worker(config, quest_registry, index, workers)
+        except BaseException:
+            logging.exception(f"Worker {index} failed")
+            code = 1
+        finally:
+            structured_logging.stop_logging()
+            os._exit(code)
+    return pid
+
+
+def supervise(config, quest_registry, workers: int) -> None:
+    stopping = False
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    # Objects allocated so far are never collected, so the collector does
+    # not touch (and copy) the shared pages in the workers
+    gc.collect()
+    gc.freeze()
+
+    children: Dict[int, int] = {}
+    for index in range(workers):
+        children[fork_worker(config, quest_registry, index, workers)] = index
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        logging.error(f"Worker {index} exited with status {status}, restarting")
+        time.sleep(RESTART_DELAY_SEC)
+        if not stopping:
+            children[fork_worker(config, quest_registry, index, workers)] = index
+
+
+def main() -> None:
+    has_uvloop = install_uvloop()
+
+    # The quests are compiled once, before fork
+    config = application.load_config()
+    settings = application.Settings(config)
+    structured_logging.setup_logging(settings.log_level, settings.log_format == "json")
+    logging.info(f"Start newyear_quest_skill, {'uvloop' if has_uvloop else 'asyncio'}")
+    quest_registry = application.init_quests(config, settings)
+
+    workers = usable_workers(worker_count(settings.workers), settings.sessions_backend)
+
+    if workers == 1:
+        try:
+            application.run(
+                application.create_app(config, quest_registry=quest_registry)
+            )
+        except application.web.GracefulExit:
+            pass
+        return
+
+    logging.info(f"Starting {workers} workers on port {settings.host_port}")
+    supervise(config, quest_registry, workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+from typing import Any, Dict, List, Optional
+
+from . import serialization, utils
+
+SIMPLE_UTTERANCE = "SimpleUtterance"
+BUTTON_PRESSED = "ButtonPressed"
+
+
+class RequestError(ValueError):
+    pass
+
+
+class SkillRequest:
+    """The fields of a Marusya request the skill uses.
+
+    meta, nlu and the rest of the payload are dropped right after decoding.
+    session is kept as is, it is echoed in the response.
+    """
+
+    __slots__ = (
+        "version",
+        "session",
+        "user_id",
+        "skill_id",
+        "new",
+        "message_id",
+        "type",
+        "command",
+        "payload_text",
+        "tokens",
+    )
+
+    def __init__(
+        self,
+        version: str,
+        session: Dict[str, Any],
+        type: Optional[str] = SIMPLE_UTTERANCE,
+        command: Optional[str] = None,
+        payload_text: Optional[str] = None,
+        tokens: Optional[List[str]] = None,
+    ) -> None:
+        self.version = version
+        self.session = session
+        self.user_id: str = session["user_id"]
+        self.skill_id: Optional[str] = session.get("skill_id")
+        self.new: bool = session["new"]
+        self.message_id: Optional[int] = session.get("message_id")
+        self.type = type
+        self.command = command
+        self.payload_text = payload_text
+        self.tokens = tokens
+
+    def text(self) -> Optional[str]:
+        if self.type == SIMPLE_UTTERANCE:
+            return self.command
+        if self.type == BUTTON_PRESSED:
+            return self.payload_text
+        return None
+
+    def words(self) -> Optional[List[str]]:
+        """Normalized words of text(), platform tokens for an utterance."""
+        tokens = self.tokens if self.type == SIMPLE_UTTERANCE else None
+        return utils.prepare_tokens(self.text(), tokens)
+
+
+def tokens_of(request: Dict[str, Any]) -> Optional[List[str]]:
+    nlu = request.get("nlu")
+    tokens = nlu.get("tokens") if isinstance(nlu, dict) else None
+    if isinstance(tokens, list) and all(isinstance(token, str) for token in tokens):
+        return tokens
+    return None
+
+
+def decode(body: bytes) -> SkillRequest:
+    """Parse a request body once and keep only the used fields."""
+    try:
+        data = serialization.loads(body)
+        session = data["session"]
+        request = data["request"]
+        payload = request.get("payload")
+        skill_request = SkillRequest(
+            data["version"],
+            session,
+            request.get("type"),
+            request.get("command"),
+            payload.get("text") if isinstance(payload, dict) else None,
+            tokens_of(request),
+        )
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise RequestError(f"Bad skill request: {e!r}") from e
+
+    # The ids are dictionary keys and the texts are normalized later, so a
+    # value of another JSON type must not get past this point
+    optional_str = (str, type(None))
+    fields = (
+        ("session.user_id", skill_request.user_id, (str,)),
+        ("session.new", skill_request.new, (bool,)),
+        ("session.session_id", session.get("session_id"), optional_str),
+        ("session.skill_id", skill_request.skill_id, optional_str),
+        ("session.message_id", skill_request.message_id, (int, type(None))),
+        ("request.command", skill_request.command, optional_str),
+        ("request.payload.text", skill_request.payload_text, optional_str),
+    )
+    for name, value, types in fields:
+        if type(value) not in types:
+            raise RequestError(f"Bad skill request: {name} is {type(value).__name__}")
+    return skill_request
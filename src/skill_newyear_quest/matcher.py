@@ -0,0 +1,59 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+class PhraseMatcher:
+    """Hash index that resolves an utterance to a transition index.
+
+    Single-word phrases live in a plain token -> index dict. Multi-word phrases
+    are indexed by their first token, so they cost an extra comparison only
+    when the utterance actually contains that token. Every phrase keeps the
+    smallest index that owns it and matching returns the smallest index found,
+    which preserves the "first transition wins" order of the old scan.
+    """
+
+    def __init__(self) -> None:
+        self.words: Dict[str, int] = {}
+        self.phrases: Dict[str, List[Tuple[Tuple[str, ...], int]]] = {}
+
+    def add(self, phrase: str, index: int) -> None:
+        if "-" in phrase:
+            # Platform tokenizers split hyphenated words
+            self._add(phrase.replace("-", " "), index)
+        self._add(phrase, index)
+
+    def _add(self, phrase: str, index: int) -> None:
+        tokens = phrase.split()
+        if not tokens:
+            return
+
+        if len(tokens) == 1:
+            current = self.words.get(tokens[0])
+            if current is None or index < current:
+                self.words[tokens[0]] = index
+        else:
+            self.phrases.setdefault(tokens[0], []).append((tuple(tokens[1:]), index))
+
+    def match_tokens(self, tokens: Sequence[str]) -> Optional[int]:
+        best: Optional[int] = None
+        words = self.words
+        phrases = self.phrases
+        for token in tokens:
+            index = words.get(token)
+            if index is not None and (best is None or index < best):
+                if index == 0:
+                    return 0
+                best = index
+
+        if phrases:
+            for position, token in enumerate(tokens):
+                for tail, index in phrases.get(token, ()):
+                    end = position + 1 + len(tail)
+                    if (best is None or index < best) and tuple(
+                        tokens[position + 1 : end]
+                    ) == tail:
+                        best = index
+
+        return best
+
+    def match(self, text: str) -> Optional[int]:
+        return self.match_tokens(text.split())
@@ -1,12 +1,35 @@
+import hashlib
+import json
 import logging
-from typing import Any, Dict, List, Optional, Tuple
+import os
+import pickle
+import stat
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
 
-from . import button_menu, utils
+from . import button_menu, matcher, phrases, serialization, utils
 
 STAGES_DICTIONARY: Dict[str, Any] = dict()
 AUDIO_URL_TEMPLATE: str = ""
 
 
+class StageResponse(NamedTuple):
+    stage_id: str
+    stage_index: int
+    text: str
+    tts: str
+    buttons: Optional[List[Dict]]
+    is_end: bool
+    # Encoded "response" object of the skill answer, see serialization.py
+    payload: serialization.Serialized
+
+
+# Module level views of the default quest, see init
+RESPONSES: Dict[Tuple[str, bool], StageResponse] = dict()
+STAGE_INDEXES: Dict[str, int] = dict()
+STAGES_LIST: List[Any] = list()
+
+
 class Transition(object):
     def __init__(self, to_id: str, main_text: str, synonims: List[str]):
         self.to_id = to_id
@@ -15,12 +38,12 @@ class Transition(object):
             utils.prepare_phrase(main_text[0]),
         ] + utils.prepare_phrases_list(synonims)
 
-    def must_go(self, selection_text: str) -> bool:
-        for word in selection_text.split(" "):
-            if word in self.synonims:
-                return True
+        self.matcher = matcher.PhraseMatcher()
+        for synonim in self.synonims:
+            self.matcher.add(synonim, 0)
 
-        return False
+    def must_go(self, selection_text: str) -> bool:
+        return self.matcher.match(selection_text) is not None
 
 
 class Stage(object):
@@ -37,19 +60,28 @@ class Stage(object):
         has_sound: bool,
         transitions: List[Transition],
         default_transition: str,
+        audio_url_template: Optional[str] = None,
     ) -> None:
-
-        global AUDIO_URL_TEMPLATE
         self.id = id
         self.texts = texts
 
+        if audio_url_template is None:
+            audio_url_template = AUDIO_URL_TEMPLATE
         if has_sound:
-            self.audio_url = AUDIO_URL_TEMPLATE.format(file_name=self.id)
+            self.audio_url = audio_url_template.format(file_name=self.id)
         else:
             self.audio_url = None
 
         self.transitions = transitions
 
+        # One phrase index per stage: an utterance is resolved in a single pass
+        # instead of calling must_go for every transition.
+        self.matcher = matcher.PhraseMatcher()
+        if transitions is not None:
+            for index, transition in enumerate(transitions):
+                for synonim in transition.synonims:
+                    self.matcher.add(synonim, index)
+
         if (transitions is not None) and (len(transitions) > 1):
             bmb = button_menu.ButtonsMenuBuilder()
             for transition in transitions:
@@ -60,28 +92,44 @@ class Stage(object):
 
         self.default_transition = default_transition
 
+        # Stages of the quest this one belongs to, set by add_to_dict
+        self.stages: Dict[str, Stage] = dict()
+
     def is_end(self) -> bool:
         return (self.transitions is None) and (self.default_transition is None)
 
     def is_unconditional(self) -> bool:
         return (self.transitions is None) and (self.default_transition is not None)
 
-    def get_next_stage(self, user_response: Optional[str] = None) -> "Stage":
-        global STAGES_DICTIONARY
-        if not self.is_unconditional():
-            for transition in self.transitions:
-                if user_response is not None:
-                    user_response_str: str = user_response
-                if transition.must_go(user_response_str):
-                    return STAGES_DICTIONARY[transition.to_id]
+    def match_next_stage(
+        self,
+        user_response: Optional[str] = None,
+        tokens: Optional[Sequence[str]] = None,
+    ) -> Tuple["Stage", bool]:
+        """Next stage and whether a transition matched, not the default one.
+
+        tokens are the normalized words of user_response, when known.
+        """
+        if not self.is_unconditional() and (
+            user_response is not None or tokens is not None
+        ):
+            if tokens is None:
+                index = self.matcher.match(user_response)
+            else:
+                index = self.matcher.match_tokens(tokens)
+            if index is not None:
+                return self.stages[self.transitions[index].to_id], True
+
+        return self.stages[self.default_transition], False
 
-        return STAGES_DICTIONARY[self.default_transition]
+    def get_next_stage(self, user_response: Optional[str] = None) -> "Stage":
+        return self.match_next_stage(user_response)[0]
 
     def add_to_dict(self, dictionary) -> None:
-        global STAGES_DICTIONARY
-        if self.id in STAGES_DICTIONARY:
+        if self.id in dictionary:
             logging.info(f"WARNING! {self.id} is already in target dictionary")
         dictionary[self.id] = self
+        self.stages = dictionary
 
     def add_response_text_and_tts(
         self, current_response: List[str], play_audio: bool = True
@@ -94,541 +142,437 @@ class Stage(object):
             current_response[0] += f"{self.texts[0]}"
             current_response[1] += f"\n{self.texts[1]}"
 
+    def build_response(
+        self, stage_indexes: Dict[str, int], play_audio: bool = True
+    ) -> StageResponse:
+        response_text_and_tts = ["", ""]
+        stage: Stage = self
+        stage.add_response_text_and_tts(response_text_and_tts, play_audio)
+        while stage.is_unconditional():
+            stage = stage.get_next_stage()
+            stage.add_response_text_and_tts(response_text_and_tts, play_audio)
+
+        buttons = stage.buttons
+        if stage.is_end():
+            response_text_and_tts[0] += f"\n{phrases.QUEST_COMPLETE_PHRASE[0]}"
+            response_text_and_tts[1] += "\n" + phrases.QUEST_COMPLETE_PHRASE[1]
+            buttons = phrases.EXIT_QUESTION_BUTTONS
+
+        payload: Dict[str, Any] = {"end_session": False}
+        utils.set_response(
+            {"response": payload},
+            text_and_tts=response_text_and_tts,
+            buttons=buttons,
+        )
+
+        return StageResponse(
+            stage.id,
+            stage_indexes[stage.id],
+            response_text_and_tts[0],
+            response_text_and_tts[1],
+            buttons,
+            stage.is_end(),
+            serialization.serialize(payload),
+        )
+
+
+class GraphReport(NamedTuple):
+    unreachable: Tuple[str, ...]
+    # (stage id, phrase, transition index that wins, shadowed transition index)
+    collisions: Tuple[Tuple[str, str, int, int], ...]
+    # Most stages a single response walks through, with its entry stage
+    longest_chain: int
+    longest_chain_entry: str
+
+
+def analyze(stages: Dict[str, "Stage"], root_id: str) -> GraphReport:
+    """Check the compiled graph before any response is built from it.
+
+    Targets that do not exist and cycles of unconditional stages (which
+    would never leave build_response) raise QuestFormatError; unreachable
+    stages and synonyms shadowed by an earlier transition of the same stage
+    are only reported.
+    """
+    for stage in stages.values():
+        targets = [transition.to_id for transition in stage.transitions or ()]
+        if stage.transitions is not None or stage.default_transition is not None:
+            targets.append(stage.default_transition)
+        for target in targets:
+            _check(
+                target in stages,
+                f"stage {stage.id}: transition to undefined stage {target}",
+            )
+
+    # Length of the unconditional chain starting at every stage
+    chains: Dict[str, int] = {}
+    for stage_id in stages:
+        path: List[str] = []
+        on_path: Set[str] = set()
+        current = stages[stage_id]
+        while current.id not in chains and current.is_unconditional():
+            _check(
+                current.id not in on_path,
+                f"unconditional cycle: {' -> '.join(path + [current.id])}",
+            )
+            path.append(current.id)
+            on_path.add(current.id)
+            current = stages[current.default_transition]
+        length = chains.setdefault(current.id, 1)
+        for path_id in reversed(path):
+            length += 1
+            chains[path_id] = length
+
+    reachable = {root_id}
+    pending = [root_id]
+    while pending:
+        stage = stages[pending.pop()]
+        targets = [transition.to_id for transition in stage.transitions or ()]
+        if stage.default_transition is not None:
+            targets.append(stage.default_transition)
+        for target in targets:
+            if target not in reachable:
+                reachable.add(target)
+                pending.append(target)
+
+    collisions = []
+    for stage in stages.values():
+        owners: Dict[str, int] = {}
+        for index, transition in enumerate(stage.transitions or ()):
+            for synonim in transition.synonims:
+                owner = owners.setdefault(synonim, index)
+                if owner != index:
+                    collisions.append((stage.id, synonim, owner, index))
+
+    longest_chain_entry = max(chains, key=chains.__getitem__)
+    return GraphReport(
+        tuple(stage_id for stage_id in stages if stage_id not in reachable),
+        tuple(collisions),
+        chains[longest_chain_entry],
+        longest_chain_entry,
+    )
+
+
+def report_graph(name: str, report: GraphReport) -> None:
+    for stage_id in report.unreachable:
+        logging.warning(f"Quest {name}: stage {stage_id} is unreachable")
+    for stage_id, synonim, owner, index in report.collisions:
+        logging.warning(
+            f"Quest {name}: stage {stage_id} phrase '{synonim}' of transition"
+            f" {index} is shadowed by transition {owner}"
+        )
+    logging.info(
+        f"Quest {name}: longest unconditional chain {report.longest_chain}"
+        f" stages from {report.longest_chain_entry}"
+    )
+
+
+def stage_order_fingerprint(stage_ids) -> str:
+    """Short digest of the stage ids in index order.
+
+    Sessions persist stage indexes, which stay valid only while the order
+    of the stages is the same.
+    """
+    digest = hashlib.sha256("\n".join(stage_ids).encode("utf-8"))
+    return digest.hexdigest()[:8]
+
+
+class Quest(object):
+    """One quest graph with its interned stage indexes and responses."""
 
-ROOT_STAGE: Optional[Any] = None
+    def __init__(
+        self,
+        name: str,
+        stages: Dict[str, Stage],
+        root_id: str,
+        responses: Optional[Dict[Tuple[str, bool], StageResponse]] = None,
+        report: Optional[GraphReport] = None,
+    ) -> None:
+        self.name = name
+        self.stages = stages
+        self.report = analyze(stages, root_id) if report is None else report
+        self.root_stage: Stage = stages[root_id]
+
+        # Stage ids interned to small ints, sessions keep the index
+        self.stage_indexes: Dict[str, int] = dict()
+        self.stages_list: List[Stage] = list()
+        for stage_id, stage in stages.items():
+            self.stage_indexes[stage_id] = len(self.stages_list)
+            self.stages_list.append(stage)
+        self.fingerprint = stage_order_fingerprint(self.stage_indexes)
+
+        # (entry stage id, play_audio) -> response of the unconditional chain
+        self.responses: Dict[Tuple[str, bool], StageResponse] = dict()
+        if responses is None:
+            self.compile_responses()
+        else:
+            self.responses.update(responses)
 
+    def compile_responses(self) -> None:
+        self.responses.clear()
+        for stage_id, stage in self.stages.items():
+            for play_audio in (True, False):
+                self.responses[(stage_id, play_audio)] = stage.build_response(
+                    self.stage_indexes, play_audio
+                )
 
-def init(audio_url_template):
-    global STAGES_DICTIONARY, ROOT_STAGE, AUDIO_URL_TEMPLATE
-    AUDIO_URL_TEMPLATE = audio_url_template
+    def get_stage_by_id(self, id: str) -> Stage:
+        return self.stages[id]
+
+    def get_stage_index(self, id: str) -> int:
+        return self.stage_indexes[id]
+
+    def get_stage_by_index(self, index: int) -> Stage:
+        if index < 0:
+            raise KeyError(index)
+        return self.stages_list[index]
 
-    # --------------------------------001--------------------------------
-    Stage(
-        "001",
-        (
-            "А что бы ты ей посоветовал? Скажи: дракон или звездочёт?",
-            "А что бы ты ей посоветовал? Скажи: \n дракон или звездочёт?",
-        ),
-        True,
-        [
-            Transition("101", ("ЗВЕЗДОЧЁТ", "ЗВЕЗДОЧЁТ"), ["звездочётом"]),
-            Transition("102", ("ДРАКОН", "ДРАКОН"), ["драконом", "переговоры"]),
-        ],
-        "101",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------101--------------------------------
-    Stage(
-        "101",
-        (
-            "Скажи принцессе: В дорогу? Или в библиотеку?",
-            "Скажи принц+ессе: \n В дор+огу? Или в библиотеку?",
-        ),
-        True,
-        [
-            Transition(
-                "201",
-                ("БИБЛИОТЕКА", "БИБЛИОТЕКА"),
-                ["библиотеку", "библиотека", "библиотеке", "книги"],
-            ),
-            Transition("304", ("ДОРОГА", "ДОРОГА"), ["дорогу", "дорога", "путь"]),
-        ],
-        "201",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------102--------------------------------
-    Stage(
-        "102",
-        (
-            "Скажи принцессе: В дорогу? Или в библиотеку?",
-            "Скажи принц+ессе: \n В дор+огу? Или в библиотеку?",
-        ),
-        True,
-        [
-            Transition(
-                "201",
-                ("БИБЛИОТЕКА", "БИБЛИОТЕКА"),
-                ["библиотеку", "библиотека", "библиотеке", "книги"],
-            ),
-            Transition("305", ("ДОРОГА", "ДОРОГА"), ["дорогу", "дорога", "путь"]),
-        ],
-        "201",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------201--------------------------------
-    Stage(
-        "201",
-        (
-            "Назови слово: История? Чудовища? Огонь?",
-            "Назови слово: \nИстория? Чудовища? Огонь?",
-        ),
-        True,
-        [
-            Transition(
-                "301", ("ИСТОРИЯ", "ИСТОРИЯ"), ["история", "колдовство", "колдовства"],
-            ),
-            Transition(
-                "302", ("ЧУДОВИЩЕ", "ЧУДОВИЩЕ"), ["чудовищ", "чудовища", "описание"]
-            ),
-            Transition("303", ("ОГОНЬ", "ОГОНЬ"), ["магические", "формы"]),
-        ],
-        "301",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------301-305--------------------------------
-    Stage("301", None, True, None, "306").add_to_dict(STAGES_DICTIONARY)
-    Stage("302", None, True, None, "306").add_to_dict(STAGES_DICTIONARY)
-    Stage("303", None, True, None, "306").add_to_dict(STAGES_DICTIONARY)
-    Stage("304", None, True, None, "306").add_to_dict(STAGES_DICTIONARY)
-    Stage("305", None, True, None, "306").add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------306--------------------------------
-    Stage(
-        "306",
-        (
-            "Скажи: Охотники? Купцы? Или рудокопы?",
-            "Скажи: \n Охотники? Купцы? Или рудокопы?",
-        ),
-        True,
-        [
-            Transition(
-                "409",
-                ("ОХОТНИКИ", "ОХОТНИКИ"),
-                ["охотник", "охотниками", "охотникам", "лучник"],
-            ),
-            Transition("410", ("КУПЦЫ", "КУПЦЫ"), ["купец", "купцам", "купцами"]),
-            Transition(
-                "411",
-                ("РУДОКОПЫ", "РУДОКОПЫ"),
-                ["рудокоп", "рудокопам", "описание", "писарем", "писарь"],
-            ),
-        ],
-        "410",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------409--------------------------------
-    Stage("409", None, True, None, "551").add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------410--------------------------------
-    Stage(
-        "410",
-        (
-            "Скажи: Бежать? Или помогать торговцу?",
-            "Скаж+и: \n Беж+ать? Или помог+ать торг+овцу?",
-        ),
-        True,
-        [
-            Transition(
-                "501",
-                ("БЕЖАТЬ", "БЕЖАТЬ"),
-                ["бежать в лес", "убежать", "убегать", "побеждать", "лес"],
-            ),
-            Transition(
-                "502",
-                ("ПОМОГАТЬ", "ПОМОГАТЬ"),
-                ["помочь торговцу", "помочь", "торговцу", "помощь"],
-            ),
-        ],
-        "502",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------501-502--------------------------------
-    Stage("501", None, True, None, "551").add_to_dict(STAGES_DICTIONARY)
-    Stage("502", None, True, None, "552").add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------411--------------------------------
-    Stage(
-        "411",
-        ("Посоветуй: Брошку? Или кинжал?", "Посоветуй: \nБр+ошку? Или кинж+ал?"),
-        True,
-        [
-            Transition("504", ("КИНЖАЛ", "КИНЖАЛ"), [],),
-            Transition("505", ("БРОШКА", "БРОШКА"), ["брошка", "брошку", "брошь"],),
-        ],
-        "505",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------504-505--------------------------------
-    Stage("504", None, True, None, "553").add_to_dict(STAGES_DICTIONARY)
-    Stage("505", None, True, None, "554").add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------551--------------------------------
-    Stage(
-        "551",
-        (
-            "Что ей ответить? У неё только одна попытка. Назови нужное число!",
-            "Что ей ответить? У неё только одна попытка. Назови нужное число!",
-        ),
-        True,
-        [
-            Transition("601", ("ШЕСТЬ", "ШЕСТЬ"), ["6"],),
-            Transition(
-                "602",
-                ("ОДНА", "ОДНА"),
-                [
-                    "ТРИ",
-                    "ЧЕТЫРЕ",
-                    "ПЯТЬ",
-                    "СЕМЬ",
-                    "ВОСЕМЬ",
-                    "ДЕВЯТЬ",
-                    "ДЕСЯТЬ",
-                    "ОДИННАДЦАТЬ",
-                    "ДВЕНАДЦАТЬ",
-                    "ТРИНАДЦАТЬ",
-                    "ЗНАЮ",
-                    "МОГУ",
-                    "ОТВЕТА",
-                    "1",
-                ],
-            ),
-            Transition("602", ("ДВЕ", "ДВЕ"), ["2", "ДВА"]),
-        ],
-        "602",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------601--------------------------------
-    Stage(
-        "601",
-        ("Скажи: Дверца? Или бойница?", "Скажи: \nДверца? Или бойница?",),
-        True,
-        [
-            Transition("801", ("ДВЕРЦА", "ДВЕРЦА"), ["дверцу"],),
-            Transition("802", ("БОЙНИЦА", "БОЙНИЦА"), ["бойницу", "башня", "башне"],),
-        ],
-        "801",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------602--------------------------------
-    Stage(
-        "602",
-        ("Скажи: Дверца? Или бойница?", "Скажи: \nДверца? Или бойница?",),
-        True,
-        [
-            Transition("801", ("ДВЕРЦА", "ДВЕРЦА"), ["дверцу"],),
-            Transition("802", ("БОЙНИЦА", "БОЙНИЦА"), ["бойницу", "башня", "башне"],),
-        ],
-        "801",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------552--------------------------------
-    Stage(
-        "552",
-        (
-            "Что ей ответить? У неё только одна попытка. Назови нужное число!",
-            "Что ей ответить? У неё только одна попытка. Назови нужное число!",
-        ),
-        True,
-        [
-            Transition("603", ("ШЕСТЬ", "ШЕСТЬ"), ["6"],),
-            Transition(
-                "604",
-                ("ОДНА", "ОДНА"),
-                [
-                    "1",
-                    "ТРИ",
-                    "ЧЕТЫРЕ",
-                    "ПЯТЬ",
-                    "СЕМЬ",
-                    "ВОСЕМЬ",
-                    "ДЕВЯТЬ",
-                    "ДЕСЯТЬ",
-                    "ОДИННАДЦАТЬ",
-                    "ДВЕНАДЦАТЬ",
-                    "ТРИНАДЦАТЬ",
-                    "ЗНАЮ",
-                    "МОГУ",
-                    "ОТВЕТА",
-                ],
-            ),
-            Transition("604", ("ДВЕ", "ДВЕ"), ["2", "ДВА"]),
-        ],
-        "604",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------603--------------------------------
-    Stage(
-        "603",
-        ("Скажи: Дверца? Или бойница?", "Скажи: \nДверца? Или бойница?",),
-        True,
-        [
-            Transition("801", ("ДВЕРЦА", "ДВЕРЦА"), ["дверцу"],),
-            Transition("802", ("БОЙНИЦА", "БОЙНИЦА"), ["бойницу", "башня", "башне"],),
-        ],
-        "801",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------604--------------------------------
-    Stage(
-        "604",
-        ("Скажи: Дверца? Или бойница?", "Скажи: \nДверца? Или бойница?",),
-        True,
-        [
-            Transition("801", ("ДВЕРЦА", "ДВЕРЦА"), ["дверцу"],),
-            Transition("802", ("БОЙНИЦА", "БОЙНИЦА"), ["бойницу", "башня", "башне"],),
-        ],
-        "801",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------553--------------------------------
-    Stage(
-        "553",
-        (
-            "Посоветуй, что ей отдать? Ковёр-самолёт? Или брошку?",
-            "Посоветуй, что ей отдать? Ковёр-самолёт? Или брошку?",
-        ),
-        True,
-        [
-            Transition(
-                "605",
-                ("КОВЁР-САМОЛЁТ", "КОВЁР-САМОЛЁТ"),
-                ["ковёр", "самолёт", "ковром", "самолётом"],
-            ),
-            Transition("606", ("БРОШКА", "БРОШКА"), ["брошка", "брошку", "брошь"],),
-        ],
-        "606",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------605--------------------------------
-    Stage(
-        "605",
-        ("Скажи: Бойница? Или подземный ход?", "Скажи: \nБойница? Или подземный ход?",),
-        True,
-        [
-            Transition("802", ("БОЙНИЦА", "БОЙНИЦА"), ["бойницу", "башня", "башне"],),
-            Transition(
-                "805",
-                ("ПОДЗЕМНЫЙ ХОД", "ПОДЗЕМНЫЙ ХОД"),
-                ["подземный", "подземным", "ход", "ходом", "подземелье"],
-            ),
-        ],
-        "805",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------606--------------------------------
-    Stage("606", None, True, None, "554").add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------554--------------------------------
-    Stage(
-        "554",
-        (
-            "Назови ответ! Первая? Вторая? Никакая?",
-            "Назови ответ! Первая? Вторая? Никакая?",
-        ),
-        True,
-        [
-            Transition("607", ("НИКАКАЯ", "НИКАКАЯ"), ["одна"],),
-            Transition("608", ("ПЕРВАЯ", "ПЕРВАЯ"), []),
-            Transition("608", ("ВТОРАЯ", "ВТОРАЯ"), []),
-        ],
-        "608",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------607--------------------------------
-    Stage(
-        "607",
-        ("Скажи: Ворота? Дверца? Бойница?", "Скажи: \nВорота? Дверца? Бойница?",),
-        True,
-        [
-            Transition("701", ("ВОРОТА", "ВОРОТА"), [],),
-            Transition("807", ("ДВЕРЦА", "ДВЕРЦА"), ["дверцу"],),
-            Transition("808", ("БОЙНИЦА", "БОЙНИЦА"), ["бойницу", "башня", "башне"],),
-        ],
-        "701",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------608--------------------------------
-    Stage(
-        "608",
-        ("Скажи: Ворота? Дверца? Бойница?", "Скажи: \nВорота? Дверца? Бойница?",),
-        True,
-        [
-            Transition("701", ("ВОРОТА", "ВОРОТА"), [],),
-            Transition("807", ("ДВЕРЦА", "ДВЕРЦА"), ["дверцу"],),
-            Transition("808", ("БОЙНИЦА", "БОЙНИЦА"), ["бойницу", "башня", "башне"],),
-        ],
-        "701",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------701--------------------------------
-    Stage(
-        "701",
-        ("Скажи: Дверца? Или бойница?", "Скажи: \nДверца? Или бойница?",),
-        True,
-        [
-            Transition("807", ("ДВЕРЦА", "ДВЕРЦА"), ["дверцу"],),
-            Transition("808", ("БОЙНИЦА", "БОЙНИЦА"), ["бойницу", "башня", "башне"]),
-        ],
-        "807",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------801-802,805--------------------------------
-    Stage("801", None, True, None, "851").add_to_dict(STAGES_DICTIONARY)
-    Stage("802", None, True, None, "851").add_to_dict(STAGES_DICTIONARY)
-    Stage("805", None, True, None, "851").add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------851--------------------------------
-    Stage(
-        "851",
-        (
-            "На кого посмотреть принцессе? На гнома? На короля-отца? На звездочёта? На Дракона?",
-            "На кого посмотреть принцессе? На гнома? На короля-отца? На звездочёта? На Дракона?",
-        ),
-        True,
-        [
-            Transition(
-                "901", ("ГНОМ", "ГНОМ"), ["гнома", "рождественский", "рождественского"],
-            ),
-            Transition(
-                "902", ("ОТЕЦ", "ОТЕЦ"), ["отца", "папа", "папу", "король", "короля"]
-            ),
-            Transition("903", ("ЗВЕЗДОЧЁТ", "ЗВЕЗДОЧЁТ"), ["звездочёта"]),
-            Transition("904", ("ДРАКОН", "ДРАКОН"), ["дракона"]),
-        ],
-        "901",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------901-904--------------------------------
-    Stage("901", None, True, None, "951").add_to_dict(STAGES_DICTIONARY)
-    Stage("902", None, True, None, "951").add_to_dict(STAGES_DICTIONARY)
-    Stage("903", None, True, None, "951").add_to_dict(STAGES_DICTIONARY)
-    Stage("904", None, True, None, "951").add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------951--------------------------------
-    Stage(
-        "951",
-        (
-            "Что тебе кажется правильнее: Сжечь? Оставить?",
-            "Что тебе кажется правильнее: \nСжечь? Оставить?",
-        ),
-        True,
-        [
-            Transition("1001", ("СЖЕЧЬ", "СЖЕЧЬ"), ["жечь"],),
-            Transition("1002", ("ОСТАВИТЬ", "ОСТАВИТЬ"), ["оставлять"]),
-        ],
-        "1002",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------1001-1002--------------------------------
-    Stage("1001", None, True, None, "1051").add_to_dict(STAGES_DICTIONARY)
-    Stage("1002", None, True, None, "1051").add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------1051--------------------------------
-    Stage(
-        "1051",
-        (
-            "Может быть, ты подскажешь ей? Куда ей идти?",
-            "Может быть, ты подскажешь ей? Куда ей идти?",
-        ),
-        True,
-        [
-            Transition(
-                "1101",
-                ("ЗЕРКАЛО", "ЗЕРКАЛО"),
-                [
-                    "зеркалу",
-                    "блюдо",
-                    "блюду",
-                    "серебряное",
-                    "серебряному",
-                    "каменный",
-                    "каменному",
-                    "звездочёт",
-                    "звездочёту",
-                    "звездочётом",
-                ],
-            ),
-            Transition(
-                "1102",
-                ("ГНОМ", "ГНОМ"),
-                [
-                    "гномы",
-                    "гному",
-                    "гномам",
-                    "мешки",
-                    "подарки",
-                    "подарками",
-                    "подарков",
-                    "сани",
-                    "мороз",
-                    "санта",
-                    "санта-клаус",
-                    "плоская",
-                ],
-            ),
-        ],
-        "1102",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------1101-1102--------------------------------
-    Stage("1101", None, True, None, None).add_to_dict(STAGES_DICTIONARY)
-    Stage("1102", None, True, None, None).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------807-808--------------------------------
-    Stage("807", None, True, None, "952").add_to_dict(STAGES_DICTIONARY)
-    Stage("808", None, True, None, "952").add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------952--------------------------------
-    Stage(
-        "952",
-        (
-            "Что тебе кажется правильнее: Сжечь? Оставить?",
-            "Что тебе кажется правильнее: \nСжечь? Оставить?",
-        ),
-        True,
-        [
-            Transition("1003", ("СЖЕЧЬ", "СЖЕЧЬ"), ["жечь"],),
-            Transition("1004", ("ОСТАВИТЬ", "ОСТАВИТЬ"), ["оставлять"]),
-        ],
-        "1004",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------1003-1004--------------------------------
-    Stage("1003", None, True, None, "1052").add_to_dict(STAGES_DICTIONARY)
-    Stage("1004", None, True, None, "1052").add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------1052--------------------------------
-    Stage(
-        "1052",
-        (
-            "Если ты заметил то, чего она не заметила, скажи ей слово, то единственное слово, которое поможет.",
-            "Если ты заметил то, чего она не заметила, скажи ей слово, то единственное слово, которое поможет.",
-        ),
-        True,
-        [
-            Transition(
-                "1103",
-                ("ФЕНИКС", "ФЕНИКС"),
-                [
-                    "феникса",
-                    "лук",
-                    "лука",
-                    "колчан",
-                    "колчане",
-                    "стрелы",
-                    "стрелами",
-                    "перья",
-                    "перьями",
-                ],
-            ),
-        ],
-        "1105",
-    ).add_to_dict(STAGES_DICTIONARY)
-
-    # --------------------------------1103,1105--------------------------------
-    Stage("1103", None, True, None, None).add_to_dict(STAGES_DICTIONARY)
-    Stage("1105", None, True, None, None).add_to_dict(STAGES_DICTIONARY)
-
-    # ROOT-ROOT-ROOT-ROOT-ROOT-ROOT-ROOT-ROOT-ROOT-ROOT-ROOT-ROOT-ROOT-ROOT
-
-    ROOT_STAGE = STAGES_DICTIONARY["001"]
+    def get_stage_response(self, id: str, play_audio: bool = True) -> StageResponse:
+        return self.responses[(id, play_audio)]
+
+    def get_root_stage(self) -> Stage:
+        return self.root_stage
+
+
+ROOT_STAGE: Optional[Any] = None
+DEFAULT_QUEST: Optional[Quest] = None
+
+QUEST_PATH = Path(__file__).parent / "data" / "quest.json"
+
+# Bump when Stage, Transition or the compiled cache layout changes
+COMPILED_FORMAT_VERSION = 4
+
+
+class QuestFormatError(ValueError):
+    pass
+
+
+def _check(condition: bool, message: str) -> None:
+    if not condition:
+        raise QuestFormatError(message)
+
+
+def _is_text_pair(value) -> bool:
+    return (
+        isinstance(value, list)
+        and len(value) == 2
+        and all(isinstance(text, str) for text in value)
+    )
+
+
+def validate(data) -> None:
+    _check(isinstance(data, dict), "quest must be an object")
+    _check(isinstance(data.get("root"), str), "root must be a stage id")
+    _check(isinstance(data.get("stages"), list), "stages must be a list")
+
+    ids = set()
+    for stage in data["stages"]:
+        _check(isinstance(stage, dict), f"stage must be an object: {stage!r}")
+        stage_id = stage.get("id")
+        _check(isinstance(stage_id, str), f"stage id must be a string: {stage!r}")
+        _check(stage_id not in ids, f"stage {stage_id} is defined twice")
+        ids.add(stage_id)
+
+        _check(
+            stage.get("texts") is None or _is_text_pair(stage["texts"]),
+            f"stage {stage_id}: texts must be null or [text, tts]",
+        )
+        _check(
+            isinstance(stage.get("has_sound"), bool),
+            f"stage {stage_id}: has_sound must be a boolean",
+        )
+        _check(
+            stage.get("default_transition") is None
+            or isinstance(stage["default_transition"], str),
+            f"stage {stage_id}: default_transition must be null or a stage id",
+        )
+
+        transitions = stage.get("transitions")
+        _check(
+            transitions is None or isinstance(transitions, list),
+            f"stage {stage_id}: transitions must be null or a list",
+        )
+        for transition in transitions or []:
+            _check(
+                isinstance(transition, dict)
+                and isinstance(transition.get("to"), str)
+                and _is_text_pair(transition.get("main_text"))
+                and isinstance(transition.get("synonims"), list)
+                and all(isinstance(text, str) for text in transition["synonims"]),
+                f"stage {stage_id}: bad transition {transition!r}",
+            )
+
+    _check(data["root"] in ids, f"root stage {data['root']} is not defined")
+
+
+def build_stages(data, audio_url_template: Optional[str] = None) -> Dict[str, Stage]:
+    stages: Dict[str, Stage] = dict()
+    for stage in data["stages"]:
+        transitions = None
+        if stage["transitions"] is not None:
+            transitions = [
+                Transition(
+                    transition["to"],
+                    tuple(transition["main_text"]),
+                    transition["synonims"],
+                )
+                for transition in stage["transitions"]
+            ]
+
+        Stage(
+            stage["id"],
+            None if stage["texts"] is None else tuple(stage["texts"]),
+            stage["has_sound"],
+            transitions,
+            stage["default_transition"],
+            audio_url_template,
+        ).add_to_dict(stages)
+
+    return stages
+
+
+def cache_key(content: bytes, audio_url_template: str) -> str:
+    digest = hashlib.sha256(content)
+    for part in (
+        COMPILED_FORMAT_VERSION,
+        audio_url_template,
+        utils.NOT_LETTERS,
+        utils.REPLACE_LETTERS,
+        phrases.QUEST_COMPLETE_PHRASE,
+        phrases.EXIT_QUESTION_BUTTONS,
+    ):
+        digest.update(repr(part).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def is_private(path: Path) -> bool:
+    """Owned by the current user and not writable by anyone else.
+
+    Unpickling runs code from the file, so a cache anybody else could have
+    written (a shared temp directory, a symlink) is never read.
+    """
+    info = os.lstat(path)
+    return (
+        not stat.S_ISLNK(info.st_mode)
+        and info.st_uid == os.getuid()
+        and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    )
+
+
+def load_cache(cache_path: Path) -> Optional[Dict]:
+    try:
+        if not (is_private(cache_path.parent) and is_private(cache_path)):
+            logging.warning(
+                f"Quest cache {cache_path} is not private to the service user,"
+                " compiling again"
+            )
+            return None
+        with cache_path.open("rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logging.warning(f"Broken quest cache {cache_path}, compiling again")
+        return None
+
+
+def save_cache(cache_path: Path, compiled: Dict) -> None:
+    try:
+        cache_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if not is_private(cache_path.parent):
+            logging.warning(
+                f"Quest cache directory {cache_path.parent} is not private"
+                " to the service user, the cache is not written"
+            )
+            return
+        temp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        logging.warning(f"Can't write quest cache {cache_path}: {e}")
+
+
+def load_quest(
+    name: str, audio_url_template: str, quest_path=None, cache_dir=None
+) -> Quest:
+    """Load a quest graph from a JSON file.
+
+    The compiled graph (stages with normalized synonyms, matchers and
+    precomputed responses) is pickled to cache_dir under the hash of the
+    file and everything the compilation depends on, so the next start only
+    unpickles it. A cache that is not private to the service user (see
+    is_private) is neither read nor written.
+    """
+    content = Path(quest_path or QUEST_PATH).read_bytes()
+
+    cache_path = None
+    if cache_dir is not None:
+        key = cache_key(content, audio_url_template)
+        cache_path = Path(cache_dir) / f"quest-{key}.pickle"
+        compiled = load_cache(cache_path)
+        if compiled is not None:
+            loaded = Quest(
+                name,
+                compiled["stages"],
+                compiled["root"],
+                compiled["responses"],
+                compiled["report"],
+            )
+            report_graph(name, loaded.report)
+            return loaded
+
+    data = json.loads(content)
+    validate(data)
+    loaded = Quest(name, build_stages(data, audio_url_template), data["root"])
+    report_graph(name, loaded.report)
+    if cache_path is not None:
+        save_cache(
+            cache_path,
+            {
+                "stages": loaded.stages,
+                "root": data["root"],
+                "responses": loaded.responses,
+                "report": loaded.report,
+            },
+        )
+    return loaded
+
+
+def set_default_quest(default_quest: Quest) -> None:
+    global DEFAULT_QUEST, STAGES_DICTIONARY, ROOT_STAGE, RESPONSES
+    global STAGE_INDEXES, STAGES_LIST
+    DEFAULT_QUEST = default_quest
+    STAGES_DICTIONARY = default_quest.stages
+    ROOT_STAGE = default_quest.root_stage
+    RESPONSES = default_quest.responses
+    STAGE_INDEXES = default_quest.stage_indexes
+    STAGES_LIST = default_quest.stages_list
+
+
+def init(audio_url_template, quest_path=None, cache_dir=None):
+    global AUDIO_URL_TEMPLATE
+    AUDIO_URL_TEMPLATE = audio_url_template
+    set_default_quest(load_quest("default", audio_url_template, quest_path, cache_dir))
 
 
 def get_stage_by_id(id: str) -> Stage:
-    global STAGES_DICTIONARY
     return STAGES_DICTIONARY[id]
 
 
+def get_stage_index(id: str) -> int:
+    return STAGE_INDEXES[id]
+
+
+def get_stage_by_index(index: int) -> Stage:
+    if index < 0:
+        raise KeyError(index)
+    return STAGES_LIST[index]
+
+
+def get_stage_response(id: str, play_audio: bool = True) -> StageResponse:
+    return RESPONSES[(id, play_audio)]
+
+
 def get_root_stage() -> Optional[Stage]:
-    global ROOT_STAGE
     return ROOT_STAGE
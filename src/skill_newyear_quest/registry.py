@@ -0,0 +1,142 @@
+import json
+import logging
+import sys
+from typing import Any, Dict, Iterable, List, Optional
+
+from . import matcher, quest, serialization
+
+
+class Interner:
+    """Shares equal immutable data between the quests of one process.
+
+    Quests built from similar graphs repeat synonyms, texts, buttons and
+    whole response payloads; after interning every quest points to one copy.
+    """
+
+    def __init__(self) -> None:
+        self.buttons: Dict[str, List[Dict[str, Any]]] = {}
+        self.payloads: Dict[bytes, serialization.Serialized] = {}
+
+    def text(self, value: Optional[str]) -> Optional[str]:
+        return None if value is None else sys.intern(value)
+
+    def button_list(self, buttons: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        key = json.dumps(buttons, ensure_ascii=False, sort_keys=True)
+        return self.buttons.setdefault(key, buttons)
+
+    def payload(self, payload: serialization.Serialized) -> serialization.Serialized:
+        return self.payloads.setdefault(payload, payload)
+
+    def phrase_matcher(self, phrase_matcher: matcher.PhraseMatcher) -> None:
+        text = self.text
+        phrase_matcher.words = {
+            text(word): index for word, index in phrase_matcher.words.items()
+        }
+        phrase_matcher.phrases = {
+            text(first): [
+                (tuple(text(token) for token in tail), index) for tail, index in tails
+            ]
+            for first, tails in phrase_matcher.phrases.items()
+        }
+
+    def intern_quest(self, current_quest: quest.Quest) -> None:
+        text = self.text
+        for stage in current_quest.stages.values():
+            if stage.texts is not None:
+                stage.texts = tuple(text(value) for value in stage.texts)
+            stage.audio_url = text(stage.audio_url)
+            self.phrase_matcher(stage.matcher)
+            for transition in stage.transitions or ():
+                transition.synonims = [text(value) for value in transition.synonims]
+                transition.main_text = tuple(
+                    text(value) for value in transition.main_text
+                )
+                self.phrase_matcher(transition.matcher)
+
+        for key, response in current_quest.responses.items():
+            current_quest.responses[key] = response._replace(
+                text=text(response.text),
+                tts=text(response.tts),
+                buttons=self.button_list(response.buttons),
+                payload=self.payload(response.payload),
+            )
+
+
+class QuestRegistry:
+    """Quests served by one process, resolved by skill id or request path.
+
+    A request is routed by the skill id of its session first, then by the
+    path it came to, and falls back to the default quest.
+    """
+
+    def __init__(self) -> None:
+        self.quests: Dict[str, quest.Quest] = {}
+        self.by_skill_id: Dict[str, quest.Quest] = {}
+        self.by_path: Dict[str, quest.Quest] = {}
+        self.default: Optional[quest.Quest] = None
+        self.interner = Interner()
+
+    def add(
+        self,
+        current_quest: quest.Quest,
+        skill_ids: Iterable[str] = (),
+        paths: Iterable[str] = (),
+        default: bool = False,
+    ) -> None:
+        if current_quest.name in self.quests:
+            raise ValueError(f"Quest {current_quest.name} is already registered")
+        self.interner.intern_quest(current_quest)
+        self.quests[current_quest.name] = current_quest
+
+        for skill_id in skill_ids:
+            if skill_id in self.by_skill_id:
+                raise ValueError(f"Skill id {skill_id} already has a quest")
+            self.by_skill_id[skill_id] = current_quest
+        for path in paths:
+            if path in self.by_path:
+                raise ValueError(f"Path {path} already has a quest")
+            self.by_path[path] = current_quest
+
+        if default or self.default is None:
+            self.default = current_quest
+        logging.info(
+            f"Quest {current_quest.name} registered,"
+            f" {len(current_quest.stages)} stages"
+        )
+
+    def load(
+        self,
+        name: str,
+        audio_url_template: str,
+        quest_path=None,
+        cache_dir=None,
+        skill_ids: Iterable[str] = (),
+        paths: Iterable[str] = (),
+        default: bool = False,
+    ) -> quest.Quest:
+        loaded = quest.load_quest(name, audio_url_template, quest_path, cache_dir)
+        self.add(loaded, skill_ids, paths, default)
+        return loaded
+
+    @property
+    def paths(self) -> List[str]:
+        return list(self.by_path)
+
+    def resolve(
+        self, skill_id: Optional[str] = None, path: Optional[str] = None
+    ) -> quest.Quest:
+        current_quest = self.by_skill_id.get(skill_id) if skill_id else None
+        if current_quest is None and path is not None:
+            current_quest = self.by_path.get(path)
+        if current_quest is None:
+            current_quest = self.default
+        if current_quest is None:
+            raise KeyError("No quests registered")
+        return current_quest
+
+    def session_key(self, current_quest: quest.Quest, user_id: str) -> str:
+        # A stored stage index means a stage of one stage order only; after
+        # quest.json changes the old sessions are not found and expire
+        if current_quest is self.default:
+            return f"{current_quest.fingerprint}:{user_id}"
+        return f"{current_quest.name}:{current_quest.fingerprint}:{user_id}"
@@ -0,0 +1,46 @@
+import json
+from typing import Any, Dict
+
+from aiohttp import web
+
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
+
+class Serialized(bytes):
+    """JSON document that is already encoded and is spliced in as is."""
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def serialize(obj: Any) -> Serialized:
+    return Serialized(dumps(obj))
+
+
+def dumps_response(response: Dict) -> bytes:
+    parts = []
+    for key, value in response.items():
+        if not isinstance(value, Serialized):
+            value = dumps(value)
+        parts.append(dumps(key) + b":" + value)
+    return b"{" + b",".join(parts) + b"}"
+
+
+def json_response(response: Dict) -> web.Response:
+    return web.Response(
+        body=dumps_response(response),
+        content_type="application/json",
+        charset="utf-8",
+    )
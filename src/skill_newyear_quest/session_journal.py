@@ -0,0 +1,234 @@
+import asyncio
+import concurrent.futures
+import logging
+import mmap
+import os
+import re
+import struct
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
+
+# magic, format version, generation, number of records
+SNAPSHOT_HEADER = struct.Struct("<4sHQI")
+SNAPSHOT_MAGIC = b"NYQS"
+SNAPSHOT_VERSION = 1
+
+LENGTH = struct.Struct("<H")
+MAX_KEY_LENGTH = 0xFFFF
+
+# Entries kept while the log cannot be written, the oldest are dropped
+MAX_PENDING = 100000
+
+OP_SET = b"S"
+OP_DELETE = b"D"
+
+SNAPSHOT_FILE_NAME = "snapshot.bin"
+LOG_FILE_NAME = "changes.{generation}.log"
+LOG_FILE_PATTERN = re.compile(r"changes\.(\d+)\.log$")
+
+
+def encode_entry(session_id: str, record: Optional[bytes]) -> bytes:
+    key = session_id.encode("utf-8")
+    if len(key) > MAX_KEY_LENGTH:
+        raise ValueError(f"Session id of {len(key)} bytes is too long for the log")
+    if record is None:
+        return OP_DELETE + LENGTH.pack(len(key)) + key
+    return OP_SET + LENGTH.pack(len(key)) + key + LENGTH.pack(len(record)) + record
+
+
+def iter_entries(data, offset: int = 0) -> Iterator[Tuple[str, Optional[bytes]]]:
+    """Decode (session id, record or None for removal) entries of a log.
+
+    A truncated entry at the end, left by a crash in the middle of a write,
+    ends the log.
+    """
+    size = len(data)
+    while offset < size:
+        op = data[offset : offset + 1]
+        if offset + 3 > size:
+            return
+        (key_length,) = LENGTH.unpack_from(data, offset + 1)
+        offset += 3
+        key_end = offset + key_length
+        if key_end > size:
+            return
+        session_id = bytes(data[offset:key_end]).decode("utf-8")
+        offset = key_end
+
+        if op == OP_DELETE:
+            yield session_id, None
+            continue
+
+        if offset + 2 > size:
+            return
+        (record_length,) = LENGTH.unpack_from(data, offset)
+        offset += 2
+        record_end = offset + record_length
+        if record_end > size:
+            return
+        yield session_id, bytes(data[offset:record_end])
+        offset = record_end
+
+
+def read_mapped(path: Path) -> Optional[mmap.mmap]:
+    with path.open("rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class SessionJournal:
+    """Snapshots plus an append-only change log of the memory session store.
+
+    Changes are encoded on the event loop into an in-memory buffer and
+    appended to changes.<generation>.log from a background thread. A
+    snapshot copies the store, starts a new log generation and writes
+    snapshot.bin from the same thread; the snapshot of generation N holds
+    everything from the logs before N, so those logs are deleted.
+    load() memory-maps the snapshot and replays the newer logs.
+    """
+
+    def __init__(self, directory: str, record_type: Type) -> None:
+        self.directory = Path(directory)
+        self.record_type = record_type
+        self.generation = 0
+        self.pending: List[bytes] = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def log_path(self, generation: int) -> Path:
+        return self.directory / LOG_FILE_NAME.format(generation=generation)
+
+    def log_generations(self) -> List[int]:
+        generations = []
+        for path in self.directory.iterdir():
+            match = LOG_FILE_PATTERN.match(path.name)
+            if match:
+                generations.append(int(match.group(1)))
+        return sorted(generations)
+
+    def _record(self, session_id: str, record: Optional[bytes]) -> None:
+        try:
+            self.pending.append(encode_entry(session_id, record))
+        except ValueError as e:
+            # The session lives on in memory, it is only not persisted
+            logging.warning(str(e))
+
+    def record_set(self, session_id: str, record: Any) -> None:
+        self._record(session_id, record.dump())
+
+    def record_delete(self, session_id: str) -> None:
+        self._record(session_id, None)
+
+    def _restore(self, pending: List[bytes]) -> None:
+        """Put back a batch that was not written, ahead of the newer changes."""
+        self.pending = pending + self.pending
+        dropped = len(self.pending) - MAX_PENDING
+        if dropped > 0:
+            del self.pending[:dropped]
+            logging.error(f"{dropped} session changes dropped from the journal")
+
+    def load(self) -> Dict[str, Any]:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        records: Dict[str, Any] = {}
+        load = self.record_type.load
+
+        snapshot_generation = 0
+        snapshot_path = self.directory / SNAPSHOT_FILE_NAME
+        if snapshot_path.exists():
+            data = read_mapped(snapshot_path)
+            if data is not None:
+                with data:
+                    magic, version, snapshot_generation, count = (
+                        SNAPSHOT_HEADER.unpack_from(data)
+                    )
+                    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                        raise ValueError(f"{snapshot_path} is not a session snapshot")
+                    for session_id, record in iter_entries(data, SNAPSHOT_HEADER.size):
+                        records[session_id] = load(session_id, record)
+
+        generations = self.log_generations()
+        for generation in generations:
+            if generation < snapshot_generation:
+                continue
+            data = read_mapped(self.log_path(generation))
+            if data is None:
+                continue
+            with data:
+                for session_id, record in iter_entries(data):
+                    if record is None:
+                        records.pop(session_id, None)
+                    else:
+                        records[session_id] = load(session_id, record)
+
+        # New changes never go to a log that may end with a truncated entry
+        self.generation = max(generations + [snapshot_generation]) + 1
+        logging.info(
+            f"Loaded {len(records)} sessions from {self.directory},"
+            f" snapshot generation {snapshot_generation}"
+        )
+        return records
+
+    async def _run(self, func, *args) -> Any:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _append(self, generation: int, entries: List[bytes]) -> None:
+        with self.log_path(generation).open("ab") as f:
+            f.write(b"".join(entries))
+
+    def _write_snapshot(
+        self,
+        generation: int,
+        items: List[Tuple[str, Any]],
+        pending: List[bytes],
+    ) -> None:
+        if pending:
+            self._append(generation - 1, pending)
+
+        path = self.directory / SNAPSHOT_FILE_NAME
+        temp_path = path.with_suffix(".tmp")
+        with temp_path.open("wb") as f:
+            f.write(
+                SNAPSHOT_HEADER.pack(
+                    SNAPSHOT_MAGIC, SNAPSHOT_VERSION, generation, len(items)
+                )
+            )
+            f.write(
+                b"".join(
+                    encode_entry(session_id, record.dump())
+                    for session_id, record in items
+                )
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+        for old_generation in self.log_generations():
+            if old_generation < generation:
+                self.log_path(old_generation).unlink()
+
+    async def flush(self) -> None:
+        if self.pending:
+            pending, self.pending = self.pending, []
+            try:
+                await self._run(self._append, self.generation, pending)
+            except BaseException:
+                self._restore(pending)
+                raise
+
+    async def snapshot(self, records: Dict[str, Any]) -> None:
+        # The copy is the only part done on the event loop
+        items = list(records.items())
+        pending, self.pending = self.pending, []
+        self.generation += 1
+        try:
+            await self._run(self._write_snapshot, self.generation, items, pending)
+        except BaseException:
+            # Replaying a change twice is harmless, losing it is not
+            self._restore(pending)
+            raise
+        logging.info(f"Session snapshot of {len(items)} sessions written")
+
+    async def close(self) -> None:
+        await self.flush()
+        self.executor.shutdown()
@@ -0,0 +1,527 @@
+import asyncio
+import concurrent.futures
+import heapq
+import logging
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple, Type
+from urllib.parse import urlparse
+
+from . import session_journal
+
+
+class SessionStoreError(Exception):
+    pass
+
+
+class SessionStore:
+    """Storage backend of user sessions.
+
+    A record is a sessions.UserSession: it has last_time and expiry_bucket
+    attributes, dump() encodes it to bytes and the class method
+    load(session_id, data) decodes it. The memory store keeps the objects
+    as they are, other stores keep the encoded bytes.
+    Writes come in batches: sessions.py collects the updates of all requests
+    handled in one event loop iteration and saves them with a single call.
+    """
+
+    batched: bool = True
+
+    async def get(self, session_id: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def set_many(self, records: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    async def delete_many(self, session_ids: Iterable[str]) -> None:
+        raise NotImplementedError
+
+    async def remove_older(self, remove_time: float) -> int:
+        """Drop sessions updated before remove_time, return how many."""
+        raise NotImplementedError
+
+    def restore(self) -> int:
+        """Load persisted sessions before serving, return how many."""
+        return 0
+
+    def add_loop_tasks(self, loop) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """In-process store with bucketed lazy expiry and an optional LRU cap.
+
+    Every session id is filed into the bucket of its last_time
+    (expiry_granularity seconds wide), which the record keeps in its
+    expiry_bucket attribute; an update moves it only when the bucket
+    changes, so a session holds one bucket slot. Expiry pops only the
+    buckets that are entirely older than the remove time, so a tick costs
+    O(expired) instead of a sweep over all sessions.
+
+    With max_sessions set, reads and writes move a session to the end of an
+    OrderedDict and the least recently used sessions are evicted once the
+    limit is exceeded. Evictions are counted with metrics.inc.
+
+    With a journal, every change is also recorded in its change log and
+    the store is snapshotted every snapshot_interval seconds, so restore()
+    brings the sessions back after a restart.
+    """
+
+    # Memory store writes are immediate, there is nothing to batch
+    batched = False
+
+    # Give the event loop a turn after this many expired entries
+    EXPIRY_CHUNK = 1000
+
+    def __init__(
+        self,
+        expiry_granularity: float = 10.0,
+        max_sessions: int = 0,
+        metrics: Optional[Any] = None,
+        journal: Optional[Any] = None,
+        journal_flush_interval: float = 1.0,
+        snapshot_interval: float = 300.0,
+    ) -> None:
+        self.records: Dict[str, Any] = OrderedDict() if max_sessions else {}
+        self.max_sessions = max_sessions
+        self.metrics = metrics
+        self.journal = journal
+        self.journal_flush_interval = journal_flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.expiry_granularity = expiry_granularity
+        self.expiry_buckets: Dict[int, Set[str]] = {}
+        self.expiry_heap: List[int] = []
+
+    async def get(self, session_id: str) -> Optional[Any]:
+        record = self.records.get(session_id, None)
+        if record is not None and self.max_sessions:
+            self.records.move_to_end(session_id)  # type: ignore
+        return record
+
+    async def set_many(self, records: Dict[str, Any]) -> None:
+        if self.journal is not None:
+            for session_id, record in records.items():
+                self.journal.record_set(session_id, record)
+        self._add(records)
+
+    def _add(self, records: Dict[str, Any]) -> None:
+        self.records.update(records)
+        if self.max_sessions:
+            self._evict(records)
+        for session_id, record in records.items():
+            bucket_id = int(record.last_time // self.expiry_granularity)
+            if bucket_id == record.expiry_bucket:
+                continue
+            self._unfile(session_id, record)
+            bucket = self.expiry_buckets.get(bucket_id)
+            if bucket is None:
+                bucket = self.expiry_buckets[bucket_id] = set()
+                heapq.heappush(self.expiry_heap, bucket_id)
+            bucket.add(session_id)
+            record.expiry_bucket = bucket_id
+
+    def _unfile(self, session_id: str, record: Any) -> None:
+        bucket = self.expiry_buckets.get(record.expiry_bucket)
+        if bucket is not None:
+            bucket.discard(session_id)
+
+    def _evict(self, records: Dict[str, Any]) -> None:
+        for session_id in records:
+            self.records.move_to_end(session_id)  # type: ignore
+
+        evicted = 0
+        while len(self.records) > self.max_sessions:
+            session_id, record = self.records.popitem(last=False)  # type: ignore
+            self._unfile(session_id, record)
+            if self.journal is not None:
+                self.journal.record_delete(session_id)
+            evicted += 1
+
+        if evicted and self.metrics is not None:
+            self.metrics.inc("sessions_evicted", evicted)
+
+    async def delete_many(self, session_ids: Iterable[str]) -> None:
+        for session_id in session_ids:
+            record = self.records.pop(session_id, None)
+            if record is not None:
+                self._unfile(session_id, record)
+            if self.journal is not None:
+                self.journal.record_delete(session_id)
+
+    async def remove_older(self, remove_time: float) -> int:
+        removed = 0
+        counter = 0
+        # Buckets before this one hold only times older than remove_time
+        limit = int(remove_time // self.expiry_granularity)
+        while self.expiry_heap and self.expiry_heap[0] < limit:
+            bucket = self.expiry_buckets.pop(heapq.heappop(self.expiry_heap))
+            for session_id in bucket:
+                record = self.records.get(session_id)
+                if record is not None and record.last_time < remove_time:
+                    del self.records[session_id]
+                    if self.journal is not None:
+                        self.journal.record_delete(session_id)
+                    removed += 1
+                counter += 1
+                if counter % self.EXPIRY_CHUNK == 0:
+                    await asyncio.sleep(0)
+
+        return removed
+
+    def restore(self) -> int:
+        if self.journal is None:
+            return 0
+        self._add(self.journal.load())
+        return len(self.records)
+
+    def add_loop_tasks(self, loop) -> None:
+        if self.journal is not None:
+            loop.create_task(self.journal_task_async())
+
+    async def journal_task_async(self) -> None:
+        assert self.journal is not None
+        last_snapshot = time.monotonic()
+        while True:
+            await asyncio.sleep(self.journal_flush_interval)
+            try:
+                if time.monotonic() - last_snapshot >= self.snapshot_interval:
+                    await self.journal.snapshot(self.records)
+                    last_snapshot = time.monotonic()
+                else:
+                    await self.journal.flush()
+            except Exception:
+                # The batch is kept by the journal and retried next time
+                logging.exception("Session journal write failed")
+
+    async def close(self) -> None:
+        if self.journal is not None:
+            await self.journal.close()
+
+
+class SqliteSessionStore(SessionStore):
+    """On-disk store, shared by all worker processes of one host.
+
+    sqlite3 is blocking, so every call runs in a dedicated thread.
+    """
+
+    def __init__(self, path: str, record_type: Type) -> None:
+        self.path = path
+        self.record_type = record_type
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, data BLOB, last_time REAL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_last_time "
+                "ON sessions (last_time)"
+            )
+        return self.connection
+
+    async def _run(self, func, *args) -> Any:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _get(self, session_id: str) -> Optional[Any]:
+        row = (
+            self._connect()
+            .execute("SELECT data FROM sessions WHERE session_id = ?", (session_id,))
+            .fetchone()
+        )
+        return None if row is None else self.record_type.load(session_id, row[0])
+
+    def _set_many(self, records: Dict[str, Any]) -> None:
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                [
+                    (session_id, record.dump(), record.last_time)
+                    for session_id, record in records.items()
+                ],
+            )
+
+    def _delete_many(self, session_ids: List[str]) -> None:
+        with self._connect() as connection:
+            connection.executemany(
+                "DELETE FROM sessions WHERE session_id = ?",
+                [(session_id,) for session_id in session_ids],
+            )
+
+    def _remove_older(self, remove_time: float) -> int:
+        with self._connect() as connection:
+            return connection.execute(
+                "DELETE FROM sessions WHERE last_time < ?", (remove_time,)
+            ).rowcount
+
+    def _close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    async def get(self, session_id: str) -> Optional[Any]:
+        return await self._run(self._get, session_id)
+
+    async def set_many(self, records: Dict[str, Any]) -> None:
+        await self._run(self._set_many, records)
+
+    async def delete_many(self, session_ids: Iterable[str]) -> None:
+        await self._run(self._delete_many, list(session_ids))
+
+    async def remove_older(self, remove_time: float) -> int:
+        return await self._run(self._remove_older, remove_time)
+
+    async def close(self) -> None:
+        await self._run(self._close)
+        self.executor.shutdown()
+
+
+class RespConnection:
+    """Minimal pipelined client of the Redis protocol (RESP2).
+
+    Callers write their commands as soon as they come and wait for a future
+    in a FIFO; one reader task takes the replies off the stream in order and
+    resolves the futures. A caller that is cancelled or times out leaves
+    its replies to the reader, so they are never read by somebody else.
+    A timeout or a broken stream closes the connection and fails everything
+    in flight; the next command connects again.
+    """
+
+    def __init__(self, host: str, port: int, db: int = 0, timeout: float = 5.0) -> None:
+        self.host = host
+        self.port = port
+        self.db = db
+        self.timeout = timeout
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.reader_task: Optional[asyncio.Task] = None
+        # (future of the replies, number of commands), in the sending order
+        self.pending: Deque[Tuple[asyncio.Future, int]] = deque()
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def encode(command: Tuple) -> bytes:
+        parts = [b"*%d\r\n" % len(command)]
+        for argument in command:
+            if not isinstance(argument, bytes):
+                argument = str(argument).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(argument), argument))
+        return b"".join(parts)
+
+    async def read_reply(self, reader: asyncio.StreamReader) -> Any:
+        """One reply; an error reply is returned as a SessionStoreError."""
+        line = await reader.readline()
+        if not line:
+            raise SessionStoreError("Connection closed by the session server")
+
+        kind, value = line[:1], line[1:-2]
+        if kind == b"+":
+            return value
+        if kind == b"-":
+            return SessionStoreError(value.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(value)
+        if kind == b"$":
+            length = int(value)
+            if length < 0:
+                return None
+            data = await reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(value)
+            if length < 0:
+                return None
+            return [await self.read_reply(reader) for _ in range(length)]
+        raise SessionStoreError(f"Unknown reply: {line!r}")
+
+    async def read_replies(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        replies: List[Any] = []
+        try:
+            while True:
+                reply = await self.read_reply(reader)
+                if not self.pending:
+                    raise SessionStoreError("Reply to no command")
+                replies.append(reply)
+                future, count = self.pending[0]
+                if len(replies) < count:
+                    continue
+                self.pending.popleft()
+                if not future.done():
+                    errors = [r for r in replies if isinstance(r, SessionStoreError)]
+                    if errors:
+                        future.set_exception(errors[0])
+                    else:
+                        future.set_result(replies)
+                replies = []
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.reset(writer, e)
+
+    def reset(self, writer: asyncio.StreamWriter, error: BaseException) -> None:
+        """Close writer and fail the commands in flight on it."""
+        if self.writer is not writer:
+            return
+        writer.close()
+        self.writer = None
+        if self.reader_task is not asyncio.current_task():
+            assert self.reader_task is not None
+            self.reader_task.cancel()
+        self.reader_task = None
+        pending, self.pending = self.pending, deque()
+        for future, _ in pending:
+            if not future.done():
+                future.set_exception(SessionStoreError(f"Session server: {error!r}"))
+
+    async def connect(self) -> asyncio.StreamWriter:
+        async with self.lock:
+            if self.writer is None:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), self.timeout
+                )
+                self.writer = writer
+                self.reader_task = asyncio.get_event_loop().create_task(
+                    self.read_replies(reader, writer)
+                )
+                if self.db:
+                    await self.send(writer, [("SELECT", self.db)])
+            return self.writer
+
+    async def send(
+        self, writer: asyncio.StreamWriter, commands: List[Tuple]
+    ) -> List[Any]:
+        future = asyncio.get_event_loop().create_future()
+        # Written and queued without a switch in between, the order matches
+        self.pending.append((future, len(commands)))
+        writer.write(b"".join(self.encode(command) for command in commands))
+        try:
+            await writer.drain()
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            error = SessionStoreError(
+                f"No reply from the session server in {self.timeout} s"
+            )
+            self.reset(writer, error)
+            raise error
+        except ConnectionError as e:
+            self.reset(writer, e)
+            raise SessionStoreError(f"Session server: {e!r}") from e
+
+    async def execute_many(self, commands: List[Tuple]) -> List[Any]:
+        writer = self.writer
+        if writer is None:
+            try:
+                writer = await self.connect()
+            except (OSError, asyncio.TimeoutError) as e:
+                raise SessionStoreError(
+                    f"Can't connect to the session server: {e!r}"
+                ) from e
+        return await self.send(writer, commands)
+
+    async def close(self) -> None:
+        async with self.lock:
+            if self.writer is not None:
+                reader_task = self.reader_task
+                self.reset(self.writer, SessionStoreError("Connection closed"))
+                if reader_task is not None:
+                    try:
+                        await reader_task
+                    except asyncio.CancelledError:
+                        pass
+
+
+class RedisSessionStore(SessionStore):
+    """Store shared by workers on any host, expiry is left to the server TTL."""
+
+    def __init__(
+        self,
+        url: str,
+        life_time: int,
+        record_type: Type,
+        key_prefix: str = "",
+        timeout: float = 5.0,
+    ) -> None:
+        parsed = urlparse(url)
+        db = parsed.path.strip("/")
+        self.connection = RespConnection(
+            parsed.hostname or "127.0.0.1", parsed.port or 6379, int(db or 0), timeout
+        )
+        self.life_time = life_time
+        self.record_type = record_type
+        self.key_prefix = key_prefix
+
+    def key(self, session_id: str) -> str:
+        return f"{self.key_prefix}{session_id}"
+
+    async def get(self, session_id: str) -> Optional[Any]:
+        (data,) = await self.connection.execute_many([("GET", self.key(session_id))])
+        return None if data is None else self.record_type.load(session_id, data)
+
+    async def set_many(self, records: Dict[str, Any]) -> None:
+        await self.connection.execute_many(
+            [
+                (
+                    "SET",
+                    self.key(session_id),
+                    record.dump(),
+                    "EX",
+                    self.life_time,
+                )
+                for session_id, record in records.items()
+            ]
+        )
+
+    async def delete_many(self, session_ids: Iterable[str]) -> None:
+        keys = [self.key(session_id) for session_id in session_ids]
+        if keys:
+            await self.connection.execute_many([("DEL", *keys)])
+
+    async def remove_older(self, remove_time: float) -> int:
+        return 0
+
+    async def close(self) -> None:
+        await self.connection.close()
+
+
+def create_store(
+    backend: str,
+    life_time: int,
+    record_type: Type,
+    path: str = "",
+    url: str = "",
+    key_prefix: str = "",
+    expiry_granularity: float = 10.0,
+    max_sessions: int = 0,
+    metrics: Optional[Any] = None,
+    snapshot_dir: str = "",
+    journal_flush_interval: float = 1.0,
+    snapshot_interval: float = 300.0,
+    timeout: float = 5.0,
+) -> SessionStore:
+    if backend == "memory":
+        journal = None
+        if snapshot_dir:
+            journal = session_journal.SessionJournal(snapshot_dir, record_type)
+        return MemorySessionStore(
+            expiry_granularity,
+            max_sessions,
+            metrics,
+            journal,
+            journal_flush_interval,
+            snapshot_interval,
+        )
+    if backend == "sqlite":
+        return SqliteSessionStore(path, record_type)
+    if backend == "redis":
+        return RedisSessionStore(url, life_time, record_type, key_prefix, timeout)
+    raise SessionStoreError(f"Unknown session store backend: {backend}")
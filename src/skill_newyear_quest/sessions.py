@@ -1,68 +1,171 @@
 import asyncio
+import enum
 import logging
+import struct
 import time
+from typing import Any, Dict, Optional, Set
 
-sessions: dict = dict()
+from . import session_store
+
+store: session_store.SessionStore = session_store.MemorySessionStore()
+
+# Sink of session cache counters, anything with inc(name, value=1)
+metrics: Optional[Any] = None
+
+
+class State(enum.IntEnum):
+    HELLO = 0
+    QUEST = 1
+    QUEST_COMPLETED = 2
+    HAVE_SAVED_QUESTION = 3
+
+
+# Indexed by value: much cheaper than State(value) when loading sessions
+STATES = tuple(State)
+
+
+# Stage index of a session that has not entered the quest yet
+NO_STAGE = -1
+
+
+class BatchWriter:
+    """Group commit of session writes.
+
+    Updates and removals requested during one event loop iteration are sent
+    to the store with a single set_many/delete_many call, and every caller
+    waits until that batch is written.
+    """
+
+    def __init__(self, store: session_store.SessionStore) -> None:
+        self.store = store
+        self.saves: Dict[str, "UserSession"] = {}
+        self.deletes: Set[str] = set()
+        self.flushed: Optional[asyncio.Future] = None
+
+    async def save(self, user_session: "UserSession") -> None:
+        self.deletes.discard(user_session.session_id)
+        self.saves[user_session.session_id] = user_session
+        await asyncio.shield(self._schedule())
+
+    async def delete(self, session_id: str) -> None:
+        self.saves.pop(session_id, None)
+        self.deletes.add(session_id)
+        await asyncio.shield(self._schedule())
+
+    def _schedule(self) -> asyncio.Future:
+        if self.flushed is None:
+            loop = asyncio.get_event_loop()
+            self.flushed = loop.create_future()
+            loop.create_task(self._flush())
+        return self.flushed
+
+    async def _flush(self) -> None:
+        saves, deletes, flushed = self.saves, self.deletes, self.flushed
+        self.saves, self.deletes, self.flushed = {}, set(), None
+        assert flushed is not None
+        try:
+            if deletes:
+                await self.store.delete_many(deletes)
+            if saves:
+                await self.store.set_many(saves)
+        except Exception as e:
+            flushed.set_exception(e)
+        else:
+            flushed.set_result(None)
+
+
+writer = BatchWriter(store)
 
 
 class UserSession:
-    def __init__(self, session_id):
+    """Compact session record: quest state, interned stage index, last update.
+
+    __slots__ drops the per-instance __dict__, and the stage is kept as an
+    index from quest.get_stage_index instead of the stage id string.
+    """
+
+    __slots__ = ("session_id", "state", "stage", "last_time", "expiry_bucket")
+
+    # state, stage and last_time packed for the sqlite and redis stores
+    RECORD = struct.Struct("<bid")
+
+    def __init__(self, session_id, state=State.HELLO, stage=NO_STAGE, last_time=None):
         self.session_id = session_id
-        self.set_info({})
-        self.update()
+        self.state = state
+        self.stage = stage
+        self.last_time = time.time() if last_time is None else last_time
+        # Expiry bucket the memory store filed the session into, not stored
+        self.expiry_bucket = None
 
-    def set_info(self, info):
-        self.info = info
+    def dump(self) -> bytes:
+        return self.RECORD.pack(self.state, self.stage, self.last_time)
 
-    def update(self):
+    @classmethod
+    def load(cls, session_id, data: bytes) -> "UserSession":
+        state, stage, last_time = cls.RECORD.unpack(data)
+        return cls(session_id, STATES[state], stage, last_time)
+
+    async def update(self):
         self.last_time = time.time()
+        if store.batched:
+            await writer.save(self)
+        else:
+            await store.set_many({self.session_id: self})
 
-    def remove(self):
-        global sessions
-        sessions.pop(self.session_id, None)
+    async def remove(self):
+        if store.batched:
+            await writer.delete(self.session_id)
+        else:
+            await store.delete_many([self.session_id])
 
 
-def get_session(session_id):
-    global sessions
-    user_session = sessions.get(session_id, None)
+async def get_session(session_id) -> UserSession:
+    user_session = await store.get(session_id)
     if user_session is None:
+        if metrics is not None:
+            metrics.inc("sessions_miss")
+        # Not saved here, the handler saves it at the end of the turn
         user_session = UserSession(session_id)
-        sessions[session_id] = user_session
+    elif metrics is not None:
+        metrics.inc("sessions_hit")
     return user_session
 
 
-def init(new_session_life_time=60000):
-    global session_life_time
+def init(
+    new_session_life_time=60000,
+    new_store=None,
+    new_expiry_interval=None,
+    new_metrics=None,
+):
+    global session_life_time, expiry_interval, store, writer, metrics
     session_life_time = new_session_life_time
+    metrics = new_metrics
+    expiry_interval = (
+        new_session_life_time if new_expiry_interval is None else new_expiry_interval
+    )
+    if new_store is not None:
+        store = new_store
+        writer = BatchWriter(store)
 
 
 async def remove_old_sessions():
-    global sessions, session_life_time
     current_time = time.time()
     remove_time = current_time - session_life_time
-    delete_list = []
-    counter = 0
-    for key, value in sessions.items():
-        if value.last_time < remove_time:
-            delete_list.append(key)
-        counter += 1
-        if counter % 1000 == 0:
-            await asyncio.sleep(1)
-
-    logging.info(f"{len(delete_list)} sessions from {counter} for remove")
-
-    for delete_session in delete_list:
-        del sessions[delete_session]
-        logging.info(f"Session timeout: {delete_session}")
+    removed = await store.remove_older(remove_time)
+    if removed:
+        logging.info(f"{removed} sessions removed by timeout")
 
 
 event_loop = None
 
 
 async def task_async():
-    global session_life_time, event_loop
-    await remove_old_sessions()
-    await asyncio.sleep(session_life_time)
+    try:
+        await remove_old_sessions()
+    except Exception:
+        # A busy database or a lost connection must not stop the expiry
+        logging.exception("Removing old sessions failed")
+    await asyncio.sleep(expiry_interval)
     event_loop.create_task(task_async())
 
 
@@ -70,3 +173,4 @@ def add_loop_task(loop):
     global event_loop
     event_loop = loop
     loop.create_task(task_async())
+    store.add_loop_tasks(loop)
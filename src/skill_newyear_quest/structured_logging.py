@@ -0,0 +1,111 @@
+import atexit
+import hashlib
+import logging
+import logging.handlers
+import queue
+import random
+import time
+from typing import Any, Dict, Optional
+
+from . import serialization
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One compact JSON object per record: time, level, message and fields.
+
+    Fields are passed as logging.info(message, extra={"fields": {...}}).
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return serialization.dumps(entry).decode("utf-8")
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            text += " " + serialization.dumps(fields).decode("utf-8")
+        return text
+
+
+def setup_logging(
+    level: str = "INFO", structured: bool = False
+) -> logging.handlers.QueueListener:
+    """Route every record through a queue to a writer thread.
+
+    The event loop only puts records into the queue; formatting and the
+    blocking stream writes happen in the listener thread. A forked process
+    has no listener thread and sets up logging again.
+    """
+    global listener
+    stop_logging()
+    formatter: logging.Formatter = (
+        JsonFormatter() if structured else TextFormatter(TEXT_FORMAT)
+    )
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level.upper())
+
+    listener = logging.handlers.QueueListener(records, stream_handler)
+    listener.start()
+    return listener
+
+
+@atexit.register
+def stop_logging() -> None:
+    """Write the queued records and stop the writer thread."""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def user_hash(user_id: str) -> str:
+    """Stable pseudonym of a user id for the logs."""
+    return hashlib.blake2b(user_id.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def is_sampled(rate: float) -> bool:
+    return rate > 0 and (rate >= 1 or random.random() < rate)
+
+
+def log_request(
+    user_id: str,
+    stage_id: Optional[str],
+    intent: Optional[int],
+    started: float,
+) -> None:
+    logging.info(
+        "request",
+        extra={
+            "fields": {
+                "user": user_hash(user_id),
+                "stage": stage_id,
+                "intent": intent,
+                "latency_ms": round((time.perf_counter() - started) * 1000, 3),
+            }
+        },
+    )
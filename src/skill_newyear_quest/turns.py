@@ -0,0 +1,79 @@
+import asyncio
+import contextlib
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+# A platform retry arrives within seconds of the original request
+RESPONSE_CACHE_TTL_SEC = 30.0
+
+
+class UserLocks:
+    """One lock per user with a request in flight.
+
+    A lock is created by the first request of a user and dropped when the
+    last one waiting for it is done, so requests of different users never
+    share a lock and the table holds only the users being answered.
+    """
+
+    def __init__(self) -> None:
+        # key: [lock, number of requests holding or waiting for it]
+        self.locks: Dict[str, List] = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: str) -> AsyncIterator[None]:
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+
+class ResponseCache:
+    """Response bodies by (session id, message id) for a short time.
+
+    The platform repeats a message with the same ids when the answer is
+    late; the repeat gets the stored body and neither the session nor the
+    quest is touched again. All entries live for the same ttl, so the
+    insertion order is the expiry order; at most size entries are kept.
+    The cache and the locks belong to one process: under the launcher a
+    retry that lands on another worker is answered again.
+    """
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL_SEC, size: int = 10000) -> None:
+        self.ttl = ttl
+        self.size = size
+        # (session id, message id): (body, expiry time), oldest first
+        self.responses: "OrderedDict[Tuple[str, int], Tuple[bytes, float]]" = (
+            OrderedDict()
+        )
+
+    def get(
+        self, session_id: Optional[str], message_id: Optional[int]
+    ) -> Optional[bytes]:
+        if session_id is None or message_id is None:
+            return None
+        entry = self.responses.get((session_id, message_id))
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def put(
+        self, session_id: Optional[str], message_id: Optional[int], body: bytes
+    ) -> None:
+        if session_id is None or message_id is None or self.size <= 0:
+            return
+        now = time.monotonic()
+        responses = self.responses
+        responses[(session_id, message_id)] = (body, now + self.ttl)
+        while responses:
+            oldest = next(iter(responses.values()))
+            if oldest[1] >= now and len(responses) <= self.size:
+                break
+            responses.popitem(last=False)
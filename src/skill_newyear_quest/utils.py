@@ -38,15 +38,61 @@ def get_request_text(request) -> Optional[str]:
         return None
 
 
-NOT_LETTERS = [",", ".", "!", "?"]
+# Punctuation and quotes the voice platform puts into utterances.
+# The hyphen is kept on purpose: "ковёр-самолёт" is a single token.
+NOT_LETTERS = [
+    ",",
+    ".",
+    "!",
+    "?",
+    ";",
+    ":",
+    "(",
+    ")",
+    '"',
+    "'",
+    "«",
+    "»",
+    "„",
+    "“",
+    "”",
+    "…",
+]
+
+REPLACE_LETTERS = {"ё": "е", "Ё": "е"}
+
+
+def build_translation_table(not_letters, replace_letters) -> List[Optional[int]]:
+    # A list indexed by code point is much faster for str.translate than a
+    # dict: Cyrillic letters missing from a dict cost a LookupError each.
+    # Characters past the end of the list are left untouched.
+    symbols = list(not_letters) + list(replace_letters)
+    table: List[Optional[int]] = list(range(max(map(ord, symbols)) + 1))
+    for symbol in not_letters:
+        table[ord(symbol)] = None
+    for symbol, replacement in replace_letters.items():
+        table[ord(symbol)] = ord(replacement)
+    return table
+
+
+TRANSLATION_TABLE = build_translation_table(NOT_LETTERS, REPLACE_LETTERS)
 
 
 def prepare_phrase(phrase) -> str:
-    result = ""
-    for symbol in phrase:
-        if symbol not in NOT_LETTERS:
-            result += symbol
-    return result.replace("ё", "е").lower()
+    return " ".join(phrase.translate(TRANSLATION_TABLE).lower().split())
+
+
+def prepare_tokens(text: Optional[str], tokens=None) -> Optional[List[str]]:
+    """Normalized words of an utterance.
+
+    Platform tokens (request.nlu.tokens) are used when they are present,
+    the text is split locally otherwise.
+    """
+    if tokens:
+        return " ".join(tokens).translate(TRANSLATION_TABLE).lower().split()
+    if text is None:
+        return None
+    return text.translate(TRANSLATION_TABLE).lower().split()
 
 
 def prepare_phrases_list(prepare_list) -> List[str]:
@@ -0,0 +1,11 @@
+import pytest
+from skill_newyear_quest import application, graphite_statistics
+
+
+@pytest.fixture(scope="session", autouse=True)
+def skill_app():
+    # Loads the quests; the metrics are never flushed
+    return application.create_app(
+        application.load_config(),
+        graphite_statistics.GraphiteSender("127.0.0.1", "test"),
+    )
@@ -0,0 +1,79 @@
+import struct
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from skill_newyear_quest import audio_manifest, quest
+
+# MPEG-1 Layer III, 128 kbit/s, 44100 Hz, stereo: 417 bytes per frame
+FRAME_HEADER = b"\xff\xfb\x90\x00"
+FRAME_SIZE = 417
+FRAME_SECONDS = 1152 / 44100
+
+
+def id3_tag(size):
+    synchsafe = bytes((size >> shift) & 0x7F for shift in (21, 14, 7, 0))
+    return b"ID3\x04\x00\x00" + synchsafe + b"\x00" * size
+
+
+def mp3(seconds, tag=b"", xing=False):
+    count = round(seconds / FRAME_SECONDS)
+    frames = [FRAME_HEADER + b"\x00" * (FRAME_SIZE - 4)] * count
+    if xing:
+        info = b"Xing" + struct.pack(">II", 1, count)
+        first = FRAME_HEADER + b"\x00" * 32 + info
+        frames[0] = first + b"\x00" * (FRAME_SIZE - len(first))
+    return tag + b"".join(frames)
+
+
+@pytest.mark.parametrize(
+    "data, duration",
+    [
+        (mp3(2.0), 2.0),
+        (mp3(2.0, xing=True), 2.0),
+        (b"\x00\xff\x00" + mp3(1.0), 1.0),
+        (b"not an mp3 file", None),
+    ],
+)
+def test_mp3_duration(data, duration):
+    found = audio_manifest.mp3_duration(data, len(data))
+    if duration is None:
+        assert found is None
+    else:
+        assert found == pytest.approx(duration, rel=0.01)
+
+
+def test_id3_size():
+    data = mp3(1.0, tag=id3_tag(300))
+    assert audio_manifest.id3_size(data) == 310
+    assert audio_manifest.id3_size(mp3(1.0)) == 0
+
+
+@pytest.mark.asyncio
+async def test_check_against_stand_in(tmp_path):
+    current_quest = quest.DEFAULT_QUEST
+    for stage_id, stage in current_quest.stages.items():
+        if stage.audio_url is not None and stage_id != "001":
+            (tmp_path / f"{stage_id}.mp3").write_bytes(mp3(2.0))
+    # The first frame comes after PROBE_SIZE bytes of cover art
+    (tmp_path / "101.mp3").write_bytes(mp3(2.0, tag=id3_tag(20000)))
+
+    app = web.Application()
+    app.router.add_static("/audio", tmp_path)
+    async with TestServer(app) as server:
+        manifest = audio_manifest.AudioManifest()
+        manifest.add_quest(
+            current_quest, str(server.make_url("/audio/")) + "{file_name}.mp3"
+        )
+        await manifest.check(concurrency=4, timeout=5)
+
+    assert [asset.stage_ids for asset in manifest.broken()] == [["default:001"]]
+    assert manifest.broken()[0].error == "HTTP 404"
+    assert manifest.assets[current_quest.stages["101"].audio_url].duration == (
+        pytest.approx(2.0, rel=0.01)
+    )
+    assert ("default", "301", pytest.approx(4.0, rel=0.01)) in (
+        manifest.long_responses(3.0)
+    )
+    assert manifest.long_responses(5.0) == []
+    assert manifest.report(5.0) == 1
@@ -0,0 +1,109 @@
+import queue
+import socket
+import socketserver
+import threading
+
+import pytest
+from skill_newyear_quest import graphite_statistics
+
+
+class CarbonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.payloads.put(self.rfile.read().decode("utf-8"))
+
+
+@pytest.fixture
+def carbon_tcp():
+    """Stand-in for the carbon plaintext listener."""
+    server = socketserver.TCPServer(("127.0.0.1", 0), CarbonHandler)
+    server.payloads = queue.Queue()
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def received(server, count):
+    return [parse(server.payloads.get(timeout=5)) for _ in range(count)]
+
+
+def parse(payload):
+    values = {}
+    for line in payload.splitlines():
+        name, value, _timestamp = line.split()
+        values[name] = float(value)
+    return values
+
+
+def test_flush_sends_differences(carbon_tcp):
+    sender = graphite_statistics.GraphiteSender(
+        "127.0.0.1", "skill", carbon_tcp.server_address[1]
+    )
+    sender.inc("requests")
+    sender.inc("requests", 2)
+    sender.gauge("sessions", 10)
+    for milliseconds in range(1, 101):
+        sender.timing("handler", milliseconds / 1000.0)
+    sender.flush()
+
+    sender.inc("requests")
+    sender.flush()
+
+    first, second = received(carbon_tcp, 2)
+    assert first["skill.requests"] == 3
+    assert first["skill.sessions"] == 10
+    assert first["skill.handler.count"] == 100
+    assert first["skill.handler.mean"] == pytest.approx(50.5)
+    assert first["skill.handler.p50"] == pytest.approx(50, rel=0.05)
+    assert first["skill.handler.p99"] == pytest.approx(99, rel=0.05)
+
+    assert second["skill.requests"] == 1
+    assert second["skill.handler.count"] == 0
+    assert "skill.handler.p50" not in second
+
+
+def test_failed_flush_is_sent_later(carbon_tcp):
+    port = carbon_tcp.server_address[1]
+    sender = graphite_statistics.GraphiteSender("127.0.0.1", "skill", port)
+    sender.inc("requests")
+
+    sender.port = 1
+    sender.flush()
+    sender.port = port
+    sender.inc("requests")
+    sender.flush()
+
+    assert received(carbon_tcp, 1) == [{"skill.requests": 2}]
+    assert carbon_tcp.payloads.empty()
+
+
+def test_flush_thread(carbon_tcp):
+    sender = graphite_statistics.GraphiteSender(
+        "127.0.0.1", "skill", carbon_tcp.server_address[1]
+    )
+    sender.inc("requests")
+    sender.start(0.01)
+    try:
+        assert received(carbon_tcp, 1) == [{"skill.requests": 1}]
+    finally:
+        sender.stop()
+
+
+def test_udp_payload_is_split():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server:
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        sender = graphite_statistics.GraphiteSender(
+            "127.0.0.1", "skill", server.getsockname()[1], "udp"
+        )
+        for index in range(100):
+            sender.inc(f"counter_{index}")
+        sender.flush()
+
+        received = {}
+        while len(received) < 100:
+            datagram = server.recv(65536)
+            assert len(datagram) <= graphite_statistics.UDP_PAYLOAD_SIZE
+            received.update(parse(datagram.decode("utf-8")))
+        assert received["skill.counter_99"] == 1
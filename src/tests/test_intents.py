@@ -0,0 +1,24 @@
+from skill_newyear_quest import intents
+from skill_newyear_quest.intents import Intent
+
+
+def test_classify():
+    assert intents.classify("да") & Intent.NOT_EXIT
+    assert intents.classify("привет") == Intent.NONE
+    assert intents.classify("повтори все") == Intent.FULL_REPEAT
+    assert intents.classify("стоп") == Intent.STOP | Intent.HAVE_SAVED_EXIT
+
+
+def test_find_collisions():
+    table = intents.build_table(
+        {Intent.STOP: ["стоп", "хватит"], Intent.HAVE_SAVED_EXIT: ["нет", "стоп"]}
+    )
+    assert intents.find_collisions(table) == {
+        "стоп": Intent.STOP | Intent.HAVE_SAVED_EXIT
+    }
+
+
+def test_hyphenated_phrase_is_also_split():
+    table = intents.build_table({Intent.NOT_EXIT: ["по-другому и быть не может"]})
+    assert table["по-другому и быть не может"] == Intent.NOT_EXIT
+    assert table["по другому и быть не может"] == Intent.NOT_EXIT
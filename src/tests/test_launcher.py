@@ -0,0 +1,30 @@
+import logging
+import os
+
+from skill_newyear_quest import launcher
+
+
+def test_worker_count():
+    assert launcher.worker_count(3) == 3
+    assert launcher.worker_count(0) == (os.cpu_count() or 1)
+
+
+def test_usable_workers(caplog):
+    assert launcher.usable_workers(1, "memory") == 1
+    with caplog.at_level(logging.WARNING):
+        assert launcher.usable_workers(4, "memory") == 1
+        assert launcher.usable_workers(4, "redis") == launcher.MAX_WORKERS
+    assert len(caplog.records) == 2
+
+
+def test_sockets_share_port():
+    first = launcher.create_socket("127.0.0.1", 0)
+    port = first.getsockname()[1]
+    second = launcher.create_socket("127.0.0.1", port)
+    try:
+        first.listen()
+        second.listen()
+        assert second.getsockname()[1] == port
+    finally:
+        first.close()
+        second.close()
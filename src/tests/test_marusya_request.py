@@ -0,0 +1,70 @@
+import json
+from pathlib import Path
+
+import pytest
+from skill_newyear_quest import marusya_request
+
+base_req_file_name = Path(__file__).parent / "base_request.json"
+
+
+def load_request():
+    with open(base_req_file_name) as f:
+        return json.load(f)
+
+
+def with_field(data, section, name, value):
+    data[section][name] = value
+    return data
+
+
+def test_decode():
+    request = marusya_request.decode(base_req_file_name.read_bytes())
+    assert request.version == "1.0"
+    assert request.user_id == "222"
+    assert request.skill_id == "333"
+    assert request.new is False
+    assert request.message_id == 1
+    assert request.session["session_id"] == "111"
+    assert request.text() == "включи скилл новогодний квест"
+    assert request.words() == ["включи", "скилл", "новогодний", "квест"]
+    assert not hasattr(request, "__dict__")
+
+
+def test_decode_button():
+    data = load_request()
+    data["request"] = {"type": "ButtonPressed", "payload": {"text": "Дракон"}}
+    request = marusya_request.decode(json.dumps(data).encode("utf-8"))
+    assert request.text() == "Дракон"
+    assert request.words() == ["дракон"]
+
+
+def test_decode_ignores_bad_tokens():
+    data = load_request()
+    data["request"]["nlu"]["tokens"] = [1, 2]
+    request = marusya_request.decode(json.dumps(data).encode("utf-8"))
+    assert request.tokens is None
+    assert request.words() == ["включи", "скилл", "новогодний", "квест"]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b"",
+        b"not json",
+        b"[]",
+        b'{"version": "1.0"}',
+        json.dumps({**load_request(), "session": {"user_id": 1, "new": False}}),
+        json.dumps({**load_request(), "request": "text"}),
+        json.dumps(with_field(load_request(), "session", "message_id", [1])),
+        json.dumps(with_field(load_request(), "session", "message_id", True)),
+        json.dumps(with_field(load_request(), "session", "session_id", {"a": 1})),
+        json.dumps(with_field(load_request(), "session", "skill_id", ["a"])),
+        json.dumps(with_field(load_request(), "request", "command", 5)),
+        json.dumps(with_field(load_request(), "request", "payload", {"text": 5})),
+    ],
+)
+def test_decode_rejects_bad_requests(body):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    with pytest.raises(marusya_request.RequestError):
+        marusya_request.decode(body)
@@ -0,0 +1,171 @@
+import json
+
+import pytest
+from skill_newyear_quest import matcher, phrases, quest, utils
+
+
+def test_matcher_first_transition_wins():
+    phrase_matcher = matcher.PhraseMatcher()
+    phrase_matcher.add("дорога", 1)
+    phrase_matcher.add("книги", 0)
+    phrase_matcher.add("дорога", 2)
+
+    assert phrase_matcher.match("дорога или книги") == 0
+    assert phrase_matcher.match("дорога") == 1
+    assert phrase_matcher.match("не знаю") is None
+
+
+def test_matcher_multi_word_phrase():
+    phrase_matcher = matcher.PhraseMatcher()
+    phrase_matcher.add("бежать в лес", 0)
+    phrase_matcher.add("лес", 1)
+
+    assert phrase_matcher.match("давай бежать в лес") == 0
+    assert phrase_matcher.match("в лес") == 1
+    assert phrase_matcher.match("бежать в") is None
+
+
+def test_matcher_hyphenated_phrase():
+    phrase_matcher = matcher.PhraseMatcher()
+    phrase_matcher.add("ковер-самолет", 0)
+
+    assert phrase_matcher.match_tokens(["на", "ковер-самолет"]) == 0
+    assert phrase_matcher.match_tokens(["на", "ковер", "самолет"]) == 0
+    assert phrase_matcher.match_tokens(["ковер"]) is None
+
+
+@pytest.mark.parametrize(
+    "stage_id, text, next_stage_id",
+    [
+        ("410", "бежать в лес", "501"),
+        ("410", "я хочу помочь торговцу", "502"),
+        ("605", "подземный ход", "805"),
+        ("001", "дракон", "102"),
+        ("001", "не знаю", "101"),
+    ],
+)
+def test_get_next_stage(stage_id, text, next_stage_id):
+    stage = quest.get_stage_by_id(stage_id)
+    assert stage.get_next_stage(text).id == next_stage_id
+
+
+def test_stage_response_follows_unconditional_chain():
+    response = quest.get_stage_response("301", play_audio=True)
+    assert response.stage_id == "306"
+    assert response.text == quest.get_stage_by_id("306").texts[0]
+    assert response.tts.count("<speaker") == 2
+    assert not response.is_end
+
+    silent = quest.get_stage_response("301", play_audio=False)
+    assert "<speaker" not in silent.tts
+    assert silent.text == response.text
+
+
+def test_stage_response_end():
+    response = quest.get_stage_response("1101")
+    assert response.is_end
+    assert response.buttons == phrases.EXIT_QUESTION_BUTTONS
+    assert response.text.endswith(phrases.QUEST_COMPLETE_PHRASE[0])
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda data: data.update(root="404"),
+        lambda data: data["stages"].append(dict(data["stages"][0])),
+        lambda data: data["stages"][0].update(texts=["only text"]),
+        lambda data: data["stages"][0]["transitions"][0].pop("to"),
+    ],
+)
+def test_validate_rejects_bad_quest(change):
+    data = json.loads(quest.QUEST_PATH.read_text(encoding="utf-8"))
+    quest.validate(data)
+    change(data)
+    with pytest.raises(quest.QuestFormatError):
+        quest.validate(data)
+
+
+def test_init_uses_compiled_cache(tmp_path, monkeypatch):
+    audio_url_template = quest.AUDIO_URL_TEMPLATE
+    responses = dict(quest.RESPONSES)
+    try:
+        quest.init(audio_url_template, cache_dir=tmp_path)
+        assert len(list(tmp_path.glob("quest-*.pickle"))) == 1
+
+        # A cached start never normalizes synonyms
+        monkeypatch.setattr(utils, "prepare_phrase", None)
+        quest.init(audio_url_template, cache_dir=tmp_path)
+        assert quest.RESPONSES == responses
+        assert quest.get_root_stage().id == "001"
+    finally:
+        monkeypatch.undo()
+        quest.init(audio_url_template)
+
+
+def test_cache_not_private_is_ignored(tmp_path, monkeypatch):
+    audio_url_template = quest.AUDIO_URL_TEMPLATE
+    cache_dir = tmp_path / "cache"
+    try:
+        quest.init(audio_url_template, cache_dir=cache_dir)
+        assert cache_dir.stat().st_mode & 0o777 == 0o700
+        cache_dir.chmod(0o777)
+
+        # Anybody could have planted the pickle, the quest is compiled again
+        calls = []
+        prepare_phrase = utils.prepare_phrase
+        monkeypatch.setattr(
+            utils,
+            "prepare_phrase",
+            lambda phrase: calls.append(phrase) or prepare_phrase(phrase),
+        )
+        quest.init(audio_url_template, cache_dir=cache_dir)
+        assert calls
+    finally:
+        monkeypatch.undo()
+        quest.init(audio_url_template)
+
+
+def load_quest_data():
+    return json.loads(quest.QUEST_PATH.read_text(encoding="utf-8"))
+
+
+def find_stage(data, stage_id):
+    return next(stage for stage in data["stages"] if stage["id"] == stage_id)
+
+
+def test_analyze_quest():
+    report = quest.DEFAULT_QUEST.report
+    assert report.unreachable == ()
+    assert report.collisions == ()
+    assert (report.longest_chain, report.longest_chain_entry) == (2, "301")
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda data: find_stage(data, "001")["transitions"][0].update(to="404"),
+        lambda data: find_stage(data, "301").update(default_transition="404"),
+        lambda data: find_stage(data, "001").update(default_transition=None),
+        # 301 -> 306 -> 301
+        lambda data: find_stage(data, "306").update(
+            transitions=None, default_transition="301"
+        ),
+    ],
+)
+def test_analyze_rejects_broken_graph(change):
+    data = load_quest_data()
+    change(data)
+    stages = quest.build_stages(data)
+    with pytest.raises(quest.QuestFormatError):
+        quest.analyze(stages, data["root"])
+
+
+def test_analyze_reports_unreachable_and_collisions():
+    data = load_quest_data()
+    root = find_stage(data, "001")
+    root["transitions"][1]["synonims"].append("звездочётом")
+    root["transitions"][1]["to"] = "101"
+
+    report = quest.analyze(quest.build_stages(data), data["root"])
+    assert "102" in report.unreachable
+    assert ("001", "звездочетом", 0, 1) in report.collisions
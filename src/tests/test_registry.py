@@ -0,0 +1,83 @@
+import json
+
+import pytest
+from skill_newyear_quest import quest, registry
+
+
+@pytest.fixture
+def quest_registry():
+    quest_registry = registry.QuestRegistry()
+    quest_registry.load("main", quest.AUDIO_URL_TEMPLATE, default=True)
+    quest_registry.load(
+        "second",
+        "https://example.com/{file_name}.mp3",
+        skill_ids=["skill-2"],
+        paths=["/second"],
+    )
+    return quest_registry
+
+
+def test_resolve(quest_registry):
+    main = quest_registry.quests["main"]
+    second = quest_registry.quests["second"]
+
+    assert quest_registry.resolve("skill-2", "/") is second
+    assert quest_registry.resolve(None, "/second") is second
+    assert quest_registry.resolve("unknown", "/unknown") is main
+    assert quest_registry.session_key(main, "user") == f"{main.fingerprint}:user"
+    assert (
+        quest_registry.session_key(second, "user")
+        == f"second:{second.fingerprint}:user"
+    )
+
+
+def test_session_key_follows_stage_order(tmp_path, quest_registry):
+    data = json.loads(quest.QUEST_PATH.read_text(encoding="utf-8"))
+    data["stages"].insert(1, data["stages"].pop())
+    reordered_path = tmp_path / "quest.json"
+    reordered_path.write_text(json.dumps(data), encoding="utf-8")
+    reordered = quest_registry.load(
+        "reordered", quest.AUDIO_URL_TEMPLATE, reordered_path, paths=["/reordered"]
+    )
+
+    # Indexes saved under the old order must not be read with the new one
+    main = quest_registry.quests["main"]
+    assert reordered.fingerprint != main.fingerprint
+    assert quest.Quest("copy", main.stages, "001").fingerprint == main.fingerprint
+
+
+def test_quests_are_independent(quest_registry):
+    main = quest_registry.quests["main"]
+    second = quest_registry.quests["second"]
+
+    assert main.get_root_stage().get_next_stage("дракон") is main.get_stage_by_id("102")
+    assert second.get_root_stage().get_next_stage("дракон") is second.get_stage_by_id(
+        "102"
+    )
+    assert "example.com" in second.get_stage_response("001").tts
+    assert "example.com" not in main.get_stage_response("001").tts
+
+
+def test_quests_share_interned_data(quest_registry):
+    main = quest_registry.quests["main"]
+    second = quest_registry.quests["second"]
+
+    # Without audio the responses of both quests are equal and shared
+    assert (
+        main.get_stage_response("301", False).payload
+        is second.get_stage_response("301", False).payload
+    )
+    assert (
+        main.get_stage_by_id("001").texts[0] is second.get_stage_by_id("001").texts[0]
+    )
+
+    # Quests with the same audio template share the URL strings
+    third = quest_registry.load("third", quest.AUDIO_URL_TEMPLATE, paths=["/third"])
+    assert (
+        main.get_stage_by_id("001").audio_url is third.get_stage_by_id("001").audio_url
+    )
+
+
+def test_duplicate_quest_is_rejected(quest_registry):
+    with pytest.raises(ValueError):
+        quest_registry.add(quest_registry.quests["main"])
@@ -0,0 +1,23 @@
+import json
+
+import pytest
+from skill_newyear_quest import serialization
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_response(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(serialization, "orjson", None)
+
+    payload = {"end_session": False, "text": "Ковёр-самолёт", "buttons": None}
+    response = {
+        "version": "1.0",
+        "session": {"user_id": "222"},
+        "response": serialization.serialize(payload),
+    }
+
+    assert json.loads(serialization.dumps_response(response)) == {
+        "version": "1.0",
+        "session": {"user_id": "222"},
+        "response": payload,
+    }
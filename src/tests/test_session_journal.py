@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+from skill_newyear_quest import session_journal, session_store, sessions
+
+
+def make_store(directory):
+    journal = session_journal.SessionJournal(str(directory), sessions.UserSession)
+    store = session_store.MemorySessionStore(journal=journal)
+    store.restore()
+    return store
+
+
+def snapshot_state(store):
+    return {
+        session_id: (record.state, record.stage, record.last_time)
+        for session_id, record in store.records.items()
+    }
+
+
+@pytest.mark.asyncio
+async def test_restore_snapshot_and_log(tmp_path):
+    store = make_store(tmp_path)
+    await store.set_many(
+        {f"user-{i}": sessions.UserSession(f"user-{i}", stage=i) for i in range(10)}
+    )
+    await store.delete_many(["user-3"])
+    await store.journal.snapshot(store.records)
+
+    await store.set_many(
+        {"user-4": sessions.UserSession("user-4", sessions.State.QUEST, 40)}
+    )
+    await store.delete_many(["user-5"])
+    await store.close()
+
+    restored = make_store(tmp_path)
+    assert snapshot_state(restored) == snapshot_state(store)
+    assert restored.records["user-4"].stage == 40
+    # Logs older than the snapshot are gone
+    assert restored.journal.log_generations() == [2]
+    await restored.close()
+
+
+@pytest.mark.asyncio
+async def test_truncated_log_entry(tmp_path):
+    store = make_store(tmp_path)
+    await store.set_many(
+        {"a": sessions.UserSession("a"), "b": sessions.UserSession("b")}
+    )
+    await store.close()
+
+    log_path = store.journal.log_path(store.journal.generation)
+    log_path.write_bytes(log_path.read_bytes()[:-5])
+
+    restored = make_store(tmp_path)
+    assert list(restored.records) == ["a"]
+    await restored.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_write_is_retried(tmp_path):
+    store = make_store(tmp_path)
+    store.journal_flush_interval = 0.01
+    append = store.journal._append
+    failures = []
+
+    def failing_append(generation, entries):
+        if not failures:
+            failures.append(generation)
+            raise OSError("No space left on device")
+        append(generation, entries)
+
+    store.journal._append = failing_append
+    await store.set_many({"a": sessions.UserSession("a")})
+    task = asyncio.ensure_future(store.journal_task_async())
+    await asyncio.sleep(0.1)
+    assert failures and not task.done()
+    task.cancel()
+    await store.set_many({"b": sessions.UserSession("b")})
+    await store.close()
+
+    restored = make_store(tmp_path)
+    assert list(restored.records) == ["a", "b"]
+    await restored.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_is_capped(tmp_path, monkeypatch):
+    monkeypatch.setattr(session_journal, "MAX_PENDING", 3)
+    journal = session_journal.SessionJournal(str(tmp_path), sessions.UserSession)
+
+    def failing_append(generation, entries):
+        raise OSError("No space left on device")
+
+    journal._append = failing_append
+    journal.pending = [b"1", b"2", b"3", b"4"]
+    with pytest.raises(OSError):
+        await journal.flush()
+    # The oldest changes are dropped
+    assert journal.pending == [b"2", b"3", b"4"]
+
+
+def test_long_session_id_is_not_recorded(tmp_path):
+    journal = session_journal.SessionJournal(str(tmp_path), sessions.UserSession)
+    journal.record_set("a" * 0x10000, sessions.UserSession("a"))
+    journal.record_delete("a" * 0x10000)
+    journal.record_delete("a" * 0xFFFF)
+    assert len(journal.pending) == 1
@@ -0,0 +1,247 @@
+import asyncio
+
+import pytest
+from skill_newyear_quest import session_store, sessions
+
+
+class FakeRespServer:
+    """Stand-in for a Redis server: GET, SET, DEL and SELECT over RESP2."""
+
+    def __init__(self):
+        self.data = {}
+        self.commands = []
+        # key: seconds to wait before answering a GET of it
+        self.delays = {}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        command = []
+        for _ in range(int(line[1:-2])):
+            length = int((await reader.readline())[1:-2])
+            command.append((await reader.readexactly(length + 2))[:-2])
+        return command
+
+    async def handle(self, reader, writer):
+        while True:
+            command = await self.read_command(reader)
+            if command is None:
+                break
+            self.commands.append(command)
+            name = command[0].upper()
+            if name == b"GET":
+                await asyncio.sleep(self.delays.get(command[1], 0))
+                value = self.data.get(command[1])
+                if value is None:
+                    writer.write(b"$-1\r\n")
+                else:
+                    writer.write(b"$%d\r\n%s\r\n" % (len(value), value))
+            elif name == b"SET":
+                self.data[command[1]] = command[2]
+                writer.write(b"+OK\r\n")
+            elif name == b"DEL":
+                removed = sum(
+                    self.data.pop(key, None) is not None for key in command[1:]
+                )
+                writer.write(b":%d\r\n" % removed)
+            elif name == b"SELECT":
+                writer.write(b"+OK\r\n")
+            else:
+                writer.write(b"-ERR unknown command\r\n")
+            await writer.drain()
+        writer.close()
+
+
+@pytest.fixture(autouse=True)
+def restore_store(monkeypatch):
+    # sessions.init replaces module globals, put the defaults back afterwards
+    monkeypatch.setattr(sessions, "store", sessions.store)
+    monkeypatch.setattr(sessions, "writer", sessions.writer)
+    monkeypatch.setattr(sessions, "metrics", sessions.metrics)
+
+
+async def check_store(store):
+    sessions.init(60, store)
+
+    user_session = await sessions.get_session("user")
+    # A new session is saved by the end of the turn, not by the lookup
+    assert await store.get("user") is None
+    user_session.state = sessions.State.QUEST
+    user_session.stage = 7
+    await user_session.update()
+    loaded = await sessions.get_session("user")
+    assert (loaded.state, loaded.stage) == (sessions.State.QUEST, 7)
+    assert loaded.last_time == user_session.last_time
+
+    others = [await sessions.get_session(f"user-{i}") for i in range(10)]
+    await asyncio.gather(*(other.remove() for other in others))
+    assert await store.get("user-0") is None
+
+    await user_session.remove()
+    assert await store.get("user") is None
+
+
+@pytest.mark.asyncio
+async def test_memory_store():
+    await check_store(session_store.MemorySessionStore())
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store(tmp_path):
+    store = session_store.SqliteSessionStore(
+        str(tmp_path / "sessions.sqlite3"), sessions.UserSession
+    )
+    await check_store(store)
+    await store.set_many(
+        {
+            "old": sessions.UserSession("old", last_time=1.0),
+            "new": sessions.UserSession("new", last_time=100.0),
+        }
+    )
+    assert await store.remove_older(50.0) == 1
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_redis_store():
+    server = FakeRespServer()
+    port = await server.start()
+    store = session_store.RedisSessionStore(
+        f"redis://127.0.0.1:{port}/1", 60, sessions.UserSession, "q:"
+    )
+    await check_store(store)
+    await store.close()
+    await server.stop()
+
+    # Removals of one loop iteration are sent as a single DEL
+    deletes = [command[1:] for command in server.commands if command[0] == b"DEL"]
+    assert {f"q:user-{i}".encode() for i in range(10)} in map(set, deletes)
+    assert [b"SELECT", b"1"] == server.commands[0]
+
+
+@pytest.mark.asyncio
+async def test_redis_replies_stay_with_their_commands():
+    server = FakeRespServer()
+    port = await server.start()
+    store = session_store.RedisSessionStore(
+        f"redis://127.0.0.1:{port}/0", 60, sessions.UserSession, timeout=0.5
+    )
+    await store.set_many(
+        {
+            "slow": sessions.UserSession("slow", sessions.State.QUEST, 7),
+            "fast": sessions.UserSession("fast", sessions.State.QUEST, 1),
+        }
+    )
+    server.delays[b"slow"] = 0.05
+
+    # The reply to a cancelled GET must not be read by the next command
+    slow = asyncio.ensure_future(store.get("slow"))
+    await asyncio.sleep(0.01)
+    slow.cancel()
+    assert (await store.get("fast")).stage == 1
+
+    # Concurrent reads share the connection and get their own replies
+    loaded = await asyncio.gather(store.get("fast"), store.get("slow"))
+    assert [record.stage for record in loaded] == [1, 7]
+
+    # A stalled server fails the request, the next one connects again
+    server.delays[b"slow"] = 1.0
+    with pytest.raises(session_store.SessionStoreError):
+        await store.get("slow")
+    assert (await store.get("fast")).stage == 1
+
+    await store.close()
+    await server.stop()
+
+
+@pytest.mark.asyncio
+async def test_memory_store_expiry():
+    store = session_store.MemorySessionStore(expiry_granularity=10.0)
+    await store.set_many(
+        {
+            f"user-{i}": sessions.UserSession(f"user-{i}", last_time=float(i))
+            for i in range(100)
+        }
+    )
+    # user-5 came back later, its old bucket entry must not expire it
+    await store.set_many({"user-5": sessions.UserSession("user-5", last_time=95.0)})
+    await store.delete_many(["user-7"])
+
+    assert await store.remove_older(50.0) == 48
+    assert sorted(store.records) == ["user-5"] + [f"user-{i}" for i in range(50, 100)]
+    # Only the buckets before the remove time were touched
+    assert min(store.expiry_buckets) == 5
+
+
+@pytest.mark.asyncio
+async def test_memory_store_files_session_once():
+    store = session_store.MemorySessionStore(expiry_granularity=10.0)
+    user_session = sessions.UserSession("user", last_time=1.0)
+    for last_time in range(1, 100):
+        user_session.last_time = float(last_time)
+        await store.set_many({"user": user_session})
+
+    assert sum(len(bucket) for bucket in store.expiry_buckets.values()) == 1
+    await store.delete_many(["user"])
+    assert sum(len(bucket) for bucket in store.expiry_buckets.values()) == 0
+
+
+class FailingExpiryStore(session_store.MemorySessionStore):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    async def remove_older(self, remove_time):
+        self.calls += 1
+        if self.calls < 3:
+            raise OSError("database is locked")
+        # Ends the chain of expiry tasks
+        raise asyncio.CancelledError()
+
+
+@pytest.mark.asyncio
+async def test_expiry_goes_on_after_errors(monkeypatch):
+    store = FailingExpiryStore()
+    sessions.init(60, store, new_expiry_interval=0.01)
+    monkeypatch.setattr(sessions, "event_loop", asyncio.get_event_loop())
+
+    await sessions.task_async()
+    for _ in range(100):
+        if store.calls == 3:
+            break
+        await asyncio.sleep(0.01)
+    assert store.calls == 3
+
+
+class CountingMetrics:
+    def __init__(self):
+        self.metrics = {}
+
+    def inc(self, name, value=1):
+        self.metrics[name] = self.metrics.get(name, 0) + value
+
+
+@pytest.mark.asyncio
+async def test_memory_store_lru():
+    metrics = CountingMetrics()
+    store = session_store.MemorySessionStore(max_sessions=3, metrics=metrics)
+    sessions.init(60, store, new_metrics=metrics)
+
+    for user_id in ("a", "b", "c", "a", "d"):
+        await (await sessions.get_session(user_id)).update()
+
+    assert list(store.records) == ["c", "a", "d"]
+    assert metrics.metrics == {
+        "sessions_miss": 4,
+        "sessions_hit": 1,
+        "sessions_evicted": 1,
+    }
@@ -1,8 +1,11 @@
 import asyncio
+import itertools
 import json
+import logging
 from pathlib import Path
 
 import pytest
+from aiohttp.test_utils import TestClient, TestServer
 import skill_newyear_quest
 import skill_newyear_quest.application
 import skill_newyear_quest.phrases
@@ -10,14 +13,19 @@ import skill_newyear_quest.quest
 
 base_req_file_name = Path(__file__).parent / "base_request.json"
 
+# The platform numbers the messages, repeated ids are retries
+message_ids = itertools.count(100)
+
 
 class FakeRequest:
-    def __init__(self, json):
+    def __init__(self, app, json, path="/"):
+        self.app = app
         self._json = json
+        self.path = path
 
-    async def json(self):
+    async def read(self):
         await asyncio.sleep(0.001)
-        return self._json
+        return json.dumps(self._json).encode("utf-8")
 
 
 @pytest.mark.asyncio
@@ -31,19 +39,199 @@ class FakeRequest:
         ("историю", False, "306"),
     ],
 )
-async def test_skill(phrase_text, new_session, answer):
+async def test_skill(skill_app, phrase_text, new_session, answer):
 
     req = {}
     with open(base_req_file_name) as f:
         req = json.load(f)
 
     req["request"]["command"] = phrase_text
+    req["request"]["nlu"]["tokens"] = phrase_text.split()
     req["session"]["new"] = new_session
+    req["session"]["message_id"] = next(message_ids)
 
-    resp = await skill_newyear_quest.application.marusya_newyear_quest(FakeRequest(req))
+    resp = await skill_newyear_quest.application.marusya_newyear_quest(
+        FakeRequest(skill_app, req)
+    )
     if new_session:
         assert json.loads(resp.text)["response"]["text"] in answer
     else:
         skill_newyear_quest.quest.get_stage_by_id(answer).texts[0] in json.loads(
             resp.text
         )["response"]["text"]
+
+
+@pytest.mark.asyncio
+async def test_get_main_counts_queries(skill_app):
+    metrics = skill_app[skill_newyear_quest.application.METRICS]
+    before = metrics.counters.get("query_get", 0)
+    resp = await skill_newyear_quest.application.get_main(FakeRequest(skill_app, {}))
+    assert json.loads(resp.text)["status"] == "OK"
+    assert metrics.counters["query_get"] == before + 1
+
+
+@pytest.mark.asyncio
+async def test_handler_spans(skill_app):
+    metrics = skill_newyear_quest.application.graphite_statistics.GraphiteSender(
+        "127.0.0.1", "test"
+    )
+    app = skill_newyear_quest.application.create_app(
+        skill_newyear_quest.application.load_config(),
+        metrics,
+        skill_app[skill_newyear_quest.application.QUESTS],
+    )
+    with open(base_req_file_name) as f:
+        req = json.load(f)
+    req["session"]["user_id"] = "spans"
+    dialog = [("квест", True), ("да", False), ("звездочёт", False), ("не", False)]
+    for phrase_text, new_session in dialog:
+        req["request"]["command"] = phrase_text
+        req["request"]["nlu"]["tokens"] = phrase_text.split()
+        req["session"]["new"] = new_session
+        req["session"]["message_id"] = next(message_ids)
+        await skill_newyear_quest.application.marusya_newyear_quest(
+            FakeRequest(app, req)
+        )
+
+    timers = metrics.summary()["timers"]
+    for name in ["span.parse", "span.session", "span.response", "span.serialize"]:
+        assert timers[name]["count"] == 4
+    assert timers["span.intent"]["count"] == 3
+    assert timers["match.matched"]["count"] == 1
+    assert timers["match.default"]["count"] == 1
+    assert timers["stage.001"]["count"] == 1
+    assert timers["stage.101"]["count"] == 1
+
+
+@pytest.mark.asyncio
+async def test_intent_of_hyphenated_phrase_with_split_tokens(skill_app):
+    with open(base_req_file_name) as f:
+        req = json.load(f)
+    req["session"]["user_id"] = "hyphen"
+    phrase_text = "по-другому и быть не может"
+    for command, tokens, new_session in [
+        ("квест", ["квест"], True),
+        (phrase_text, ["по", "другому", "и", "быть", "не", "может"], False),
+    ]:
+        req["request"]["command"] = command
+        req["request"]["nlu"]["tokens"] = tokens
+        req["session"]["new"] = new_session
+        req["session"]["message_id"] = next(message_ids)
+        resp = await skill_newyear_quest.application.marusya_newyear_quest(
+            FakeRequest(skill_app, req)
+        )
+
+    # NOT_EXIT starts the quest instead of saying goodbye
+    assert not json.loads(resp.text)["response"]["end_session"]
+    root_text = skill_newyear_quest.quest.get_root_stage().texts[0]
+    assert root_text in json.loads(resp.text)["response"]["text"]
+
+
+@pytest.mark.asyncio
+async def test_retry_is_answered_once(skill_app):
+    metrics = skill_newyear_quest.application.graphite_statistics.GraphiteSender(
+        "127.0.0.1", "test"
+    )
+    app = skill_newyear_quest.application.create_app(
+        skill_newyear_quest.application.load_config(),
+        metrics,
+        skill_app[skill_newyear_quest.application.QUESTS],
+    )
+    with open(base_req_file_name) as f:
+        req = json.load(f)
+    req["session"]["user_id"] = "retry"
+    for phrase_text, new_session in [("квест", True), ("да", False)]:
+        req["request"]["command"] = phrase_text
+        req["request"]["nlu"]["tokens"] = phrase_text.split()
+        req["session"]["new"] = new_session
+        req["session"]["message_id"] = next(message_ids)
+        await skill_newyear_quest.application.marusya_newyear_quest(
+            FakeRequest(app, req)
+        )
+
+    req["request"]["command"] = "звездочёт"
+    req["request"]["nlu"]["tokens"] = ["звездочёт"]
+    req["session"]["message_id"] = next(message_ids)
+    responses = await asyncio.gather(
+        *[
+            skill_newyear_quest.application.marusya_newyear_quest(FakeRequest(app, req))
+            for _ in range(3)
+        ]
+    )
+
+    retry = await skill_newyear_quest.application.marusya_newyear_quest(
+        FakeRequest(app, req)
+    )
+
+    assert len({response.body for response in responses + [retry]}) == 1
+    assert metrics.summary()["counters"]["requests_repeated"] == 3
+    assert metrics.summary()["timers"]["stage.101"]["count"] == 1
+    # Only the first delivery of every message loads the session
+    assert metrics.summary()["timers"]["span.session"]["count"] == 3
+    assert app[skill_newyear_quest.application.LOCKS].locks == {}
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(skill_app):
+    app = skill_newyear_quest.application.create_app(
+        skill_newyear_quest.application.load_config(),
+        skill_newyear_quest.application.graphite_statistics.GraphiteSender(
+            "127.0.0.1", "test"
+        ),
+        skill_app[skill_newyear_quest.application.QUESTS],
+    )
+    async with TestClient(TestServer(app)) as client:
+        assert (await client.get("/readiness_probe")).status == 200
+        assert (await client.get("/unknown")).status == 404
+        timers = (await (await client.get("/metrics")).json())["timers"]
+
+    assert timers["route.get.readiness_probe"]["count"] == 1
+    assert timers["route.unmatched"]["count"] == 1
+    assert timers["route.get.readiness_probe"]["p99"] > 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("payload_rate, payloads", [(0, 0), (1, 1)])
+async def test_request_log(skill_app, monkeypatch, caplog, payload_rate, payloads):
+    settings = skill_app[skill_newyear_quest.application.SETTINGS]
+    monkeypatch.setattr(settings, "log_payload_rate", payload_rate)
+    with open(base_req_file_name) as f:
+        req = json.load(f)
+    req["request"]["command"] = "да"
+    req["request"]["nlu"]["tokens"] = ["да"]
+    req["session"]["new"] = False
+    req["session"]["message_id"] = next(message_ids)
+
+    with caplog.at_level(logging.INFO):
+        await skill_newyear_quest.application.marusya_newyear_quest(
+            FakeRequest(skill_app, req)
+        )
+
+    records = [record for record in caplog.records if record.msg == "request"]
+    assert len(records) == 1
+    assert set(records[0].fields) == {"user", "stage", "intent", "latency_ms"}
+    assert req["session"]["user_id"] not in records[0].fields.values()
+    logged = [record for record in caplog.records if record.msg == "payload"]
+    assert len(logged) == payloads
+
+
+@pytest.mark.asyncio
+async def test_bad_requests_are_rejected(skill_app):
+    config = skill_newyear_quest.application.load_config()
+    config.set("main", "max_body_size", "4096")
+    app = skill_newyear_quest.application.create_app(
+        config,
+        skill_newyear_quest.application.graphite_statistics.GraphiteSender(
+            "127.0.0.1", "test"
+        ),
+        skill_app[skill_newyear_quest.application.QUESTS],
+    )
+    with open(base_req_file_name) as f:
+        req = json.load(f)
+    async with TestClient(TestServer(app)) as client:
+        assert (await client.post("/", json=req)).status == 200
+        assert (await client.post("/", data=b"{")).status == 400
+        bad_req = {**req, "session": {**req["session"], "session_id": {"a": 1}}}
+        assert (await client.post("/", json=bad_req)).status == 400
+        req["meta"]["padding"] = "x" * 4096
+        assert (await client.post("/", json=req)).status == 413
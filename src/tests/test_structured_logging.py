@@ -0,0 +1,49 @@
+import json
+import logging
+
+import pytest
+from skill_newyear_quest import structured_logging
+
+
+def test_json_formatter():
+    record = logging.LogRecord("root", logging.INFO, __file__, 1, "request", (), None)
+    record.fields = {"user": "abc", "stage": "001", "latency_ms": 1.5}
+    entry = json.loads(structured_logging.JsonFormatter().format(record))
+    assert entry["message"] == "request"
+    assert entry["level"] == "INFO"
+    assert entry["stage"] == "001"
+    assert entry["latency_ms"] == 1.5
+
+
+def test_is_sampled():
+    assert not structured_logging.is_sampled(0)
+    assert structured_logging.is_sampled(1)
+    assert 200 < sum(structured_logging.is_sampled(0.5) for _ in range(1000)) < 800
+
+
+@pytest.fixture
+def restore_root_logger():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield
+    structured_logging.stop_logging()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_records_are_written_by_listener(restore_root_logger, capsys):
+    structured_logging.setup_logging("INFO", structured=True)
+    structured_logging.log_request("user-1", "101", 2, 0.0)
+    logging.debug("not written")
+    structured_logging.stop_logging()
+
+    lines = capsys.readouterr().err.splitlines()
+    assert len(lines) == 1
+    entry = json.loads(lines[0])
+    assert entry["user"] == structured_logging.user_hash("user-1")
+    assert entry["user"] != "user-1"
+    assert entry["stage"] == "101"
+    assert entry["intent"] == 2
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+from skill_newyear_quest import turns
+
+
+@pytest.mark.asyncio
+async def test_user_locks_serialize_one_user():
+    locks = turns.UserLocks()
+    events = []
+
+    async def turn(key, name):
+        async with locks.hold(key):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{name} end")
+
+    await asyncio.gather(turn("a", "first"), turn("a", "second"), turn("b", "other"))
+
+    assert events.index("first end") < events.index("second start")
+    assert events.index("other start") < events.index("first end")
+    assert locks.locks == {}
+
+
+def test_response_cache(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(turns.time, "monotonic", lambda: now[0])
+    cache = turns.ResponseCache(ttl=30, size=2)
+    cache.put("session", 5, b"five")
+
+    assert cache.get("session", 5) == b"five"
+    assert cache.get("session", 6) is None
+    assert cache.get("other session", 5) is None
+    assert cache.get("session", None) is None
+
+    now[0] += 31
+    assert cache.get("session", 5) is None
+    cache.put("session", 6, b"six")
+    assert list(cache.responses) == [("session", 6)]
+
+    cache.put("session", 7, b"seven")
+    cache.put("session", 8, b"eight")
+    assert list(cache.responses) == [("session", 7), ("session", 8)]
+
+
+def test_response_cache_disabled():
+    cache = turns.ResponseCache(size=0)
+    cache.put("session", 1, b"one")
+    assert cache.get("session", 1) is None
@@ -0,0 +1,29 @@
+import pytest
+from skill_newyear_quest import utils
+
+
+@pytest.mark.parametrize(
+    "phrase, prepared",
+    [
+        ("Да, давай!", "да давай"),
+        ("  Ну...   ЗВЁЗДОЧЁТ?  ", "ну звездочет"),
+        ("«Ковёр-самолёт» …", "ковер-самолет"),
+        ("", ""),
+    ],
+)
+def test_prepare_phrase(phrase, prepared):
+    assert utils.prepare_phrase(phrase) == prepared
+
+
+@pytest.mark.parametrize(
+    "text, tokens, words",
+    [
+        ("Звездочёт!", ["звездочёт"], ["звездочет"]),
+        ("ковёр-самолёт", ["ковёр", "самолёт"], ["ковер", "самолет"]),
+        ("Да, давай", None, ["да", "давай"]),
+        ("Да, давай", [], ["да", "давай"]),
+        (None, None, None),
+    ],
+)
+def test_prepare_tokens(text, tokens, words):
+    assert utils.prepare_tokens(text, tokens) == words